@@ -1,25 +1,134 @@
 # coding: utf-8
 
 import os
-import io
 import json
+import time
+import queue
 import base64
+from contextlib import closing
 
-from flask import Flask, request, send_file
+from flask import Flask, Response, request, g
 from flask_restful import Resource, Api
 from flask_restful import reqparse
+from werkzeug.datastructures import Range
 
 from models.users import User
 from models.pdfs import PDF
 from models.tasks import Task
 from models.images import Image
+from models.db import config, config_path
+from models.events import TaskEvents, TaskEventBroker
+from models.admission import Admission
+from models.metrics import Metrics, CONTENT_TYPE
 from models.model import ModelError, ModelNotExistError
+from compiler.templates import TemplateRegistry
 
 
 app = Flask(__name__)
 api = Api(app)
 script_dir = os.path.dirname(os.path.realpath(__file__))
 script_dir = os.path.dirname(script_dir)
+# task events of this worker process
+task_events = TaskEventBroker()
+# templates are reloaded when config.json changes
+templates = TemplateRegistry(
+    os.path.join(script_dir, 'compiler', 'structures'),
+    config_path=config_path)
+# workers' metrics are dumped here and merged by any worker's scrape
+metrics_dir = config.get('metrics_dir')
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
+
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    Metrics.observe('anylatex_http_request_seconds',
+                    time.time() - g.request_start,
+                    method=request.method, endpoint=endpoint)
+    Metrics.inc('anylatex_http_requests_total', method=request.method,
+                endpoint=endpoint, status=response.status_code)
+    try:
+        Metrics.dump(metrics_dir, min_interval=1)
+    except OSError as e:
+        print('Fail to dump metrics', 'Error: ', e)
+    return response
+
+
+def stream_file(fileobj, length, mimetype, etag=None, chunk_size=256*1024):
+    """Stream a seekable file object, support single byte range requests.
+
+        A request of several ranges gets the whole content if any of them
+        is satisfiable.
+
+    """
+    if etag and request.if_none_match.contains(etag):
+        fileobj.close()
+        return Response(status=304, headers={'ETag': '"%s"' % etag})
+    start, end = 0, length
+    status = 200
+    headers = {'Accept-Ranges': 'bytes'}
+    if etag:
+        headers['ETag'] = '"%s"' % etag
+    # a range is only valid for the same content
+    if_range = request.if_range
+    range_valid = if_range.etag == etag if if_range.etag else not if_range.date
+    if request.range and range_valid:
+        byte_ranges = [
+            Range(request.range.units, [each]).range_for_length(length)
+            for each in request.range.ranges
+        ]
+        if not any(byte_ranges):
+            fileobj.close()
+            headers['Content-Range'] = 'bytes */%d' % length
+            return Response(status=416, headers=headers)
+        if len(byte_ranges) == 1:
+            start, end = byte_ranges[0]
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, end - 1, length)
+    headers['Content-Length'] = str(end - start)
+
+    def generate():
+        try:
+            fileobj.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = fileobj.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            fileobj.close()
+
+    return Response(generate(), status=status, headers=headers,
+                    mimetype=mimetype, direct_passthrough=True)
+
+
+def send_blob(blob, mimetype, etag=None):
+    """Send a PDF or an image's content.
+
+        Contents in a filesystem storage are served by nginx through an
+        internal redirect, others are streamed by this worker.
+
+    """
+    internal_url = blob.internal_url()
+    if internal_url:
+        response = Response(status=200, mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = internal_url
+        if etag:
+            response.headers['ETag'] = '"%s"' % etag
+        return response
+    content = blob.open_content()
+    length = blob.length
+    if length is None:
+        content.seek(0, 2)
+        length = content.tell()
+    return stream_file(content, length, mimetype, etag=etag)
 
 
 class UserAPI(Resource):
@@ -49,21 +158,72 @@ class UserAPI(Resource):
             return {'error': str(e)}, 404
 
 
+class UserListAPI(Resource):
+
+    """Pages of a user's documents in descending id order, newest first
+    for tasks and pdfs.
+
+        A page has at most `limit` items and a `next_cursor` to pass as
+        `cursor` for the next page, null on the last page.
+
+    """
+
+    model = None
+    key = ''
+    fields = []
+    max_limit = 100
+
+    def get(self, user_id):
+        parser = reqparse.RequestParser()
+        parser.add_argument('cursor', type=str, required=False,
+                            location='args')
+        parser.add_argument('limit', type=int, required=False,
+                            default=20, location='args')
+        args = parser.parse_args()
+        limit = min(max(args['limit'], 1), self.max_limit)
+        try:
+            if not User(user_id=user_id).exists_in_db():
+                return {'error': 'No user of id {}'.format(user_id)}, 404
+        except ModelError as e:
+            return {'error': str(e)}, 404
+        try:
+            items, next_cursor = self.model.page_from_db(
+                {'user_id': user_id}, self.fields, after=args['cursor'],
+                limit=limit)
+        except ModelError as e:
+            return {'error': str(e)}, 400
+        return {self.key: items, 'next_cursor': next_cursor}, 200
+
+
+class UserTasksAPI(UserListAPI):
+
+    model = Task
+    key = 'tasks'
+    fields = ['document_id', 'status', 'template', 'priority',
+              'submitted_time', 'pdf_id', 'superseded_by']
+
+
+class UserPDFsAPI(UserListAPI):
+
+    model = PDF
+    key = 'pdfs'
+    fields = ['compiled_time', 'length']
+
+
+class UserImagesAPI(UserListAPI):
+
+    model = Image
+    key = 'images'
+    fields = ['uploaded_time', 'hash', 'length']
+
+
 class PDFAPI(Resource):
 
     def get(self, pdf_id):
         pdf = PDF(pdf_id=pdf_id)
         try:
             pdf.load_from_db()
-            pdf_content = base64.b64decode(pdf.data)
-            length = len(pdf_content)
-            response = send_file(
-                io.BytesIO(pdf_content),
-                attachment_filename=pdf.pdf_id+'.pdf',
-                mimetype='application/pdf'
-            )
-            response.headers['Content-Length'] = str(length)
-            return response
+            return send_blob(pdf, 'application/pdf', etag=pdf.pdf_id)
         except ModelError as e:
             return {'error': str(e)}, 404
 
@@ -87,34 +247,147 @@ class TaskAPI(Resource):
         parser.add_argument('document_id', type=str, required=True)
         parser.add_argument('part_args', type=str, required=True)
         parser.add_argument('images', type=str, required=True)
+        parser.add_argument('priority', type=str, required=False,
+                            choices=Task.priorities, default='interactive')
         args = parser.parse_args()
         args['args'] = json.loads(args['args'])
         args['part_args'] = json.loads(args['part_args'])
         args['images'] = json.loads(args['images'])
+        # refuse tasks while compilers or the user are overloaded
+        try:
+            error, retry_after, estimated_start_time = \
+                Admission.check(args['user_id'])
+        except Exception as e:
+            print('Fail to check admission', 'Error: ', e)
+            error, estimated_start_time = None, None
+        if error:
+            return {'error': error, 'retry_after': retry_after}, 429, \
+                {'Retry-After': Admission.retry_after_header(retry_after)}
         task = Task(**args)
         try:
             task_dict = task.create_in_db()
-            return task_dict, 202
         except ModelError as e:
             return {'error': str(e)}, 500
+        task_dict['estimated_start_time'] = estimated_start_time
+        # wake up compilers, they still scan the db if this fails
+        try:
+            TaskEvents.publish(task.task_id, task.status)
+        except Exception as e:
+            print('Fail to publish task', task.task_id, 'Error: ', e)
+        return task_dict, 202
 
     def delete(self, task_id):
         task = Task(task_id=task_id)
         try:
             task.delete_in_db()
-            return '', 204
         except ModelError as e:
             return {'error': str(e)}, 404
+        # stop the running compile of this task
+        try:
+            TaskEvents.publish(task_id, 'cancelled')
+        except Exception as e:
+            print('Fail to publish task', task_id, 'Error: ', e)
+        return '', 204
+
+
+class TaskStatusAPI(Resource):
+
+    """Long polling of a task's status.
+
+        Returns as soon as the status differs from the client's `status`
+        or after `timeout` seconds.
+
+    """
+
+    status_fields = ['status', 'pdf_id', 'superseded_by']
+    max_timeout = 60
+
+    def get(self, task_id):
+        parser = reqparse.RequestParser()
+        parser.add_argument('status', type=str, required=False,
+                            location='args')
+        parser.add_argument('timeout', type=float, required=False,
+                            default=30, location='args')
+        args = parser.parse_args()
+        timeout = min(max(args['timeout'], 0), self.max_timeout)
+        # subscribe before reading the status not to miss a change
+        subscriber = task_events.subscribe(task_id)
+        try:
+            task = Task(task_id=task_id)
+            try:
+                task.load_from_db(self.status_fields)
+            except ModelError as e:
+                return {'error': str(e)}, 404
+            status = {
+                'task_id': task_id,
+                'status': task.status,
+                'pdf_id': getattr(task, 'pdf_id', None),
+                'superseded_by': getattr(task, 'superseded_by', None)
+            }
+            if not args['status'] or status['status'] != args['status']:
+                return status, 200
+            deadline = time.time() + timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return status, 200
+                try:
+                    event = subscriber.get(timeout=remaining)
+                except queue.Empty:
+                    return status, 200
+                if event['status'] != args['status']:
+                    status['status'] = event['status']
+                    status['pdf_id'] = event.get('pdf_id')
+                    status['superseded_by'] = event.get('superseded_by')
+                    return status, 200
+        finally:
+            task_events.unsubscribe(task_id, subscriber)
+
+
+class TaskLatencyAPI(Resource):
+
+    """Percentiles of tasks' timeline phases by template."""
+
+    max_window = 30 * 24 * 3600
+
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('window', type=float, required=False,
+                            default=3600, location='args')
+        parser.add_argument('template', type=str, required=False,
+                            location='args')
+        parser.add_argument('status', type=str, required=False,
+                            choices=['finished', 'failed'],
+                            default='finished', location='args')
+        args = parser.parse_args()
+        window = min(max(args['window'], 0), self.max_window)
+        until = time.time()
+        try:
+            report = Task.latency_report(
+                until - window, until, template=args['template'],
+                status=args['status'])
+        except Exception as e:
+            return {'error': str(e)}, 500
+        report.update({'since': until - window, 'until': until,
+                       'percentiles': Task.report_percentiles})
+        return report, 200
 
 
 class TemplatesAPI(Resource):
 
     def get(self):
-        config_file = os.path.join(script_dir, 'config.json')
-        with open(config_file, 'r') as f:
-            config = json.load(f)
-        templates = config.get('templates', {})
-        return templates, 200
+        body, etag = templates.serialized()
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={'ETag': '"%s"' % etag})
+        return Response(body, status=200, mimetype='application/json',
+                        headers={'ETag': '"%s"' % etag})
+
+
+class MetricsAPI(Resource):
+
+    def get(self):
+        return Response(Metrics.render(metrics_dir), status=200,
+                        content_type=CONTENT_TYPE)
 
 
 class ImagesAPI(Resource):
@@ -122,20 +395,30 @@ class ImagesAPI(Resource):
     def get(self, image_id):
         parser = reqparse.RequestParser()
         parser.add_argument('check', type=str, required=False)
+        parser.add_argument('raw', type=str, required=False)
         parser.add_argument('user_id', type=str, required=True)
         args = parser.parse_args()
         user_id = args['user_id']
         image = Image(image_id=image_id, user_id=user_id)
         try:
-            user = User(user_id=user_id)
-            user.load_from_db()
-            image.load_from_db()
+            # checking an image only needs its metadata
+            fields = None
+            if args.get('check') == 'true':
+                fields = Image.metadata_fields
+            image.load_from_db(fields)
             # if image.user_id != user_id:
             #    error_info = 'User %s has no image: %s' % (user_id, image_id)
             #     raise ModelNotExistError(error_info)
+            if args.get('raw') == 'true':
+                return send_blob(image, 'application/octet-stream',
+                                 etag=image.content_hash())
             image_dict = image.to_dict()
             if args.get('check') == 'true':
-                image_dict.pop('content')
+                image_dict.pop('content', None)
+            elif not image_dict['content']:
+                with closing(image.open_content()) as f:
+                    image_dict['content'] = \
+                        base64.b64encode(f.read()).decode('utf-8')
             return image_dict, 200
         except ModelError as e:
             return {'error': str(e)}, 404
@@ -156,10 +439,16 @@ class ImagesAPI(Resource):
 
 
 api.add_resource(UserAPI, '/api/users', '/api/users/<user_id>')
+api.add_resource(UserTasksAPI, '/api/users/<user_id>/tasks')
+api.add_resource(UserPDFsAPI, '/api/users/<user_id>/pdfs')
+api.add_resource(UserImagesAPI, '/api/users/<user_id>/images')
 api.add_resource(PDFAPI, '/api/pdfs/<pdf_id>')
 api.add_resource(TaskAPI, '/api/tasks', '/api/tasks/<task_id>')
+api.add_resource(TaskStatusAPI, '/api/tasks/<task_id>/status')
+api.add_resource(TaskLatencyAPI, '/api/tasks/latency')
 api.add_resource(TemplatesAPI, '/api/templates')
 api.add_resource(ImagesAPI, '/api/images', '/api/images/<image_id>')
+api.add_resource(MetricsAPI, '/api/metrics')
 
 
 if __name__ == '__main__':
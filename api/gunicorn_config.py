@@ -0,0 +1,29 @@
+# coding: utf-8
+
+"""Gunicorn hooks of the API.
+
+    gunicorn -c api/gunicorn_config.py -k gthread --threads 16 api.api:app
+
+    Every worker connects to mongo once it is forked, with a pool of
+    `api_mongo_pool_size` connections (its threads and the events
+    listener by default), and closes them when it exits. The app may be
+    preloaded, a worker never uses the master's client. An exiting
+    worker removes its metrics dump.
+
+"""
+
+
+def post_worker_init(worker):
+    from models.db import DB, config
+
+    pool_size = config.get('api_mongo_pool_size') or worker.cfg.threads + 2
+    DB.configure(maxPoolSize=pool_size)
+    DB.warmup()
+
+
+def worker_exit(server, worker):
+    from models.db import DB, config
+    from models.metrics import Metrics
+
+    DB.close()
+    Metrics.remove_dump(config.get('metrics_dir'))
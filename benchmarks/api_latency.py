@@ -0,0 +1,406 @@
+# coding: utf-8
+
+"""Latency benchmark of the HTTP API.
+
+    Seeds a throwaway mongod (or a temporary database on `--mongo-uri`)
+    with a user, a large image, a large pdf and a task, then measures
+    every scenario:
+
+    - micro: requests through the Flask test client in a fresh process
+      per scenario, with latency histograms, traced allocations per
+      request and the process's peak RSS.
+    - load: concurrent clients in several processes against gunicorn,
+      restarted per scenario, with throughput, latency histograms and
+      workers' peak RSS.
+
+    python -m benchmarks.api_latency --mode both --output api.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import bisect
+import base64
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+import subprocess
+import http.client
+import multiprocessing
+import urllib.parse
+
+from pymongo import MongoClient
+
+from models.metrics import DEFAULT_BUCKETS
+from .throughput import (repo_dir, TEMPLATES, free_port, make_png, make_body,
+                         percentile, wait_until, start_mongod, stop)
+
+
+SCENARIOS = ['task_post', 'task_get', 'pdf_get', 'image_get', 'image_post']
+
+
+def summarize(latencies):
+    """Get percentiles and a histogram of latencies in seconds."""
+    counts = [0] * (len(DEFAULT_BUCKETS) + 1)
+    for latency in latencies:
+        counts[bisect.bisect_left(DEFAULT_BUCKETS, latency)] += 1
+    bounds = ['%g' % bound for bound in DEFAULT_BUCKETS] + ['+Inf']
+    return {
+        'count': len(latencies),
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies) if latencies else None,
+        'histogram': dict(zip(bounds, counts))
+    }
+
+
+def seed(args, tmp_dir):
+    """Create the fixtures and payloads every scenario uses.
+
+        Return:
+            path of a json file of fixtures and payloads
+    """
+    import io
+    from models.users import User
+    from models.pdfs import PDF
+    from models.tasks import Task
+    from models.images import Image
+
+    rng = random.Random(args.seed)
+    user = User()
+    user.create_in_db()
+    image_content = base64.b64encode(
+        make_png(args.image_bytes, rng)).decode('utf-8')
+    image = Image(image_id=uuid.uuid4().hex, user_id=user.user_id,
+                  content=image_content)
+    image.create_in_db()
+    pdf = PDF(user_id=user.user_id, compiled_time=str(int(time.time())))
+    pdf.save_content(io.BytesIO(os.urandom(args.pdf_bytes)))
+    pdf.create_in_db()
+    image_names = [image.image_id + '.png']
+    body = make_body(args.body_bytes, image_names, rng)
+    task = Task(user_id=user.user_id, document_id='doc0', template='article',
+                body=body, images=image_names)
+    task.create_in_db()
+    fixtures = {
+        'user_id': user.user_id,
+        'image_id': image.image_id,
+        'pdf_id': pdf.pdf_id,
+        'task_id': task.task_id,
+        'body': body,
+        'images': image_names,
+        'image_content': image_content
+    }
+    path = os.path.join(tmp_dir, 'fixtures.json')
+    with open(path, 'w') as f:
+        json.dump(fixtures, f)
+    return path
+
+
+def make_request(scenario, fixtures):
+    """Get (method, path, json body or None) of a scenario's request."""
+    if scenario == 'task_post':
+        return 'POST', '/api/tasks', {
+            'body': fixtures['body'],
+            'args': json.dumps({}),
+            'template': 'article',
+            'user_id': fixtures['user_id'],
+            'document_id': 'doc-' + uuid.uuid4().hex,
+            'part_args': json.dumps({}),
+            'images': json.dumps(fixtures['images']),
+            'priority': 'bulk'
+        }
+    if scenario == 'task_get':
+        return 'GET', '/api/tasks/' + fixtures['task_id'], None
+    if scenario == 'pdf_get':
+        return 'GET', '/api/pdfs/' + fixtures['pdf_id'], None
+    if scenario == 'image_get':
+        query = urllib.parse.urlencode({'user_id': fixtures['user_id']})
+        return 'GET', '/api/images/%s?%s' % (fixtures['image_id'], query), \
+            None
+    if scenario == 'image_post':
+        return 'POST', '/api/images', {
+            'user_id': fixtures['user_id'],
+            'image_id': uuid.uuid4().hex,
+            'content': fixtures['image_content']
+        }
+    raise ValueError('unknown scenario: %s' % scenario)
+
+
+def micro_worker(scenario, fixtures_path, iterations, alloc_iterations):
+    """Benchmark a scenario through the Flask test client, run in a
+    fresh process so the peak RSS is the scenario's."""
+    from api.api import app
+
+    with open(fixtures_path, 'r') as f:
+        fixtures = json.load(f)
+    client = app.test_client()
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def send():
+        method, path, body = make_request(scenario, fixtures)
+        response = client.open(path, method=method, json=body)
+        # streamed responses are read to the end
+        response.get_data()
+        if response.status_code >= 400:
+            raise RuntimeError('%s %s: %d' % (
+                method, path, response.status_code))
+
+    send()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        send()
+        latencies.append(time.perf_counter() - start)
+    # traced allocations slow requests down, they are measured apart
+    allocations = []
+    tracemalloc.start()
+    for _ in range(alloc_iterations):
+        tracemalloc.clear_traces()
+        send()
+        allocations.append(tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+    return {
+        'latency_seconds': summarize(latencies),
+        'allocated_peak_bytes': {
+            'p50': percentile(allocations, 50),
+            'max': max(allocations) if allocations else None
+        },
+        'baseline_rss_kb': baseline_rss,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def run_micro(args, env, fixtures_path):
+    results = {}
+    for scenario in args.scenarios:
+        output_path = fixtures_path + '.' + scenario
+        subprocess.check_call(
+            [sys.executable, '-m', 'benchmarks.api_latency',
+             '--micro-worker', scenario, '--fixtures', fixtures_path,
+             '--iterations', str(args.iterations),
+             '--alloc-iterations', str(args.alloc_iterations),
+             '--output', output_path],
+            cwd=repo_dir, env=env, stdout=subprocess.DEVNULL)
+        with open(output_path, 'r') as f:
+            results[scenario] = json.load(f)
+        print('micro', scenario,
+              results[scenario]['latency_seconds']['p50'], file=sys.stderr)
+    return results
+
+
+def load_client(scenario, fixtures_path, port, duration):
+    """Send requests of a scenario over one connection for `duration`
+    seconds.
+
+        Return:
+            (latencies, errors, received bytes)
+    """
+    with open(fixtures_path, 'r') as f:
+        fixtures = json.load(f)
+    latencies = []
+    errors = 0
+    received = 0
+    connection = None
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        method, path, body = make_request(scenario, fixtures)
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        start = time.perf_counter()
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection(
+                    '127.0.0.1', port, timeout=60)
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            received += len(response.read())
+            if response.status >= 400:
+                errors += 1
+                continue
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection = None
+            continue
+        latencies.append(time.perf_counter() - start)
+    return latencies, errors, received
+
+
+def peak_rss_of_children(pid):
+    """Get VmHWM in KB of a process's children, from /proc."""
+    peaks = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            if ppid != pid:
+                continue
+            with open('/proc/%s/status' % name) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peaks[int(name)] = int(line.split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+    return peaks
+
+
+def run_load(args, env, fixtures_path, tmp_dir):
+    results = {}
+    for scenario in args.scenarios:
+        port = free_port()
+        log = open(os.path.join(tmp_dir, 'gunicorn-%s.log' % scenario), 'w')
+        server = subprocess.Popen(
+            [args.gunicorn, '-c', 'api/gunicorn_config.py',
+             '-w', str(args.workers), '-k', 'gthread',
+             '--threads', str(args.threads), '-b', '127.0.0.1:%d' % port,
+             'api.api:app'],
+            cwd=repo_dir, env=env, stdout=log, stderr=subprocess.STDOUT,
+            start_new_session=True)
+        try:
+            if not wait_until(lambda: http.client.HTTPConnection(
+                    '127.0.0.1', port, timeout=1).connect() or True, 30):
+                raise RuntimeError('gunicorn did not start, see %s' % log.name)
+            # let every worker import the app
+            time.sleep(1)
+            start = time.time()
+            with multiprocessing.Pool(args.clients) as pool:
+                outputs = pool.starmap(load_client, [
+                    (scenario, fixtures_path, port, args.duration)
+                ] * args.clients)
+            elapsed = time.time() - start
+            latencies = [latency for output in outputs
+                         for latency in output[0]]
+            worker_rss = peak_rss_of_children(server.pid)
+            results[scenario] = {
+                'requests_per_second': len(latencies) / elapsed,
+                'errors': sum(output[1] for output in outputs),
+                'received_bytes': sum(output[2] for output in outputs),
+                'latency_seconds': summarize(latencies),
+                'worker_peak_rss_kb': {
+                    'max': max(worker_rss.values(), default=None),
+                    'sum': sum(worker_rss.values())
+                }
+            }
+            print('load', scenario,
+                  '%.1f req/s' % results[scenario]['requests_per_second'],
+                  file=sys.stderr)
+        finally:
+            stop(server)
+    return results
+
+
+def run(args):
+    tmp_dir = tempfile.mkdtemp(prefix='anylatex-api-bench-')
+    mongod = None
+    db_name = 'anylatex_bench_%s' % uuid.uuid4().hex[:8]
+    try:
+        if args.mongo_uri:
+            mongo_uri = args.mongo_uri
+        else:
+            mongod, mongo_uri = start_mongod(args.mongod, tmp_dir)
+        config = {
+            'mongo_uri': mongo_uri,
+            'db': db_name,
+            'blob_storage': args.blob_storage,
+            'blob_dir': os.path.join(tmp_dir, 'blobs'),
+            'templates': TEMPLATES
+        }
+        config_path = os.path.join(tmp_dir, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump(config, f, indent=4)
+        # models read the config when imported
+        os.environ['ANYLATEX_CONFIG'] = config_path
+        env = dict(os.environ)
+        fixtures_path = seed(args, tmp_dir)
+        result = {
+            'settings': {
+                key: value for key, value in vars(args).items()
+                if key not in ('micro_worker', 'fixtures', 'output')
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count()
+            }
+        }
+        if args.mode in ('micro', 'both'):
+            result['micro'] = run_micro(args, env, fixtures_path)
+        if args.mode in ('load', 'both'):
+            result['load'] = run_load(args, env, fixtures_path, tmp_dir)
+        return result
+    finally:
+        if args.mongo_uri:
+            client = MongoClient(args.mongo_uri)
+            client.drop_database(db_name)
+            client.close()
+        if mongod:
+            mongod.terminate()
+            mongod.wait()
+        if args.keep:
+            print('Kept files in', tmp_dir, file=sys.stderr)
+        else:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=['micro', 'load', 'both'],
+                        default='both')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS,
+                        default=SCENARIOS)
+    parser.add_argument('--body-bytes', type=int, default=200*1024)
+    parser.add_argument('--image-bytes', type=int, default=3*1024**2)
+    parser.add_argument('--pdf-bytes', type=int, default=20*1024**2)
+    parser.add_argument('--blob-storage', choices=['filesystem', 'gridfs'],
+                        default='filesystem')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--alloc-iterations', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=8,
+                        help='load generating processes')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds of load per scenario')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--gunicorn', default='gunicorn')
+    parser.add_argument('--mongod', default='mongod')
+    parser.add_argument('--mongo-uri', default=None,
+                        help='use a temporary database on this server '
+                             'instead of starting mongod')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the temporary directory and logs')
+    # a single scenario's micro benchmark in a fresh process
+    parser.add_argument('--micro-worker', default=None,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--fixtures', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.micro_worker:
+        result = micro_worker(args.micro_worker, args.fixtures,
+                              args.iterations, args.alloc_iterations)
+    else:
+        result = run(args)
+    body = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(body + '\n')
+    else:
+        print(body)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
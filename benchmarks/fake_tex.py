@@ -0,0 +1,52 @@
+# coding: utf-8
+
+"""Stand-in for a TeX run in benchmarks.
+
+    Burns `--cpu` seconds, sleeps `--sleep` seconds plus `--sleep-per-kb`
+    for every KB of the input and writes a pdf of `--size` bytes next to
+    the input like `xelatex -output-directory`.
+
+"""
+
+import os
+import sys
+import time
+import argparse
+
+
+PDF_HEADER = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+PDF_TRAILER = b'\ntrailer\n<<>>\n%%EOF\n'
+
+
+def burn(seconds):
+    end = time.process_time() + seconds
+    x = 0
+    while time.process_time() < end:
+        x = (x * 31 + 7) % 1000003
+    return x
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filepath')
+    parser.add_argument('--outdir', default=None)
+    parser.add_argument('--sleep', type=float, default=0.2)
+    parser.add_argument('--sleep-per-kb', type=float, default=0)
+    parser.add_argument('--cpu', type=float, default=0)
+    parser.add_argument('--size', type=int, default=50*1024)
+    args = parser.parse_args(argv)
+    outdir = args.outdir or os.path.dirname(args.filepath)
+    input_kb = os.path.getsize(args.filepath) / 1024
+    burn(args.cpu)
+    time.sleep(args.sleep + args.sleep_per_kb * input_kb)
+    name = os.path.splitext(os.path.basename(args.filepath))[0]
+    padding = max(0, args.size - len(PDF_HEADER) - len(PDF_TRAILER))
+    with open(os.path.join(outdir, name + '.pdf'), 'wb') as f:
+        f.write(PDF_HEADER)
+        f.write(os.urandom(padding))
+        f.write(PDF_TRAILER)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
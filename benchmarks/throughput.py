@@ -0,0 +1,445 @@
+# coding: utf-8
+
+"""End-to-end throughput benchmark of the local compiler.
+
+    Starts a throwaway mongod (or uses a database on `--mongo-uri`), runs
+    `python -m compiler.compiler` against it with a fake TeX command (see
+    `fake_tex.py`) or xelatex, submits a synthetic mix of tasks and writes
+    the results as JSON:
+
+    python -m benchmarks.throughput --tasks 200 --compilers 4 \\
+        --mix mixed --output results.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import uuid
+import base64
+import random
+import shlex
+import shutil
+import signal
+import socket
+import struct
+import argparse
+import platform
+import tempfile
+import subprocess
+import urllib.request
+
+from pymongo import MongoClient
+
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# task kinds of a mix, picked by weight
+MIXES = {
+    'small': [
+        {'weight': 1, 'template': 'article', 'body_bytes': 2000,
+         'images': 0, 'image_bytes': 0}
+    ],
+    'mixed': [
+        {'weight': 6, 'template': 'article', 'body_bytes': 2000,
+         'images': 0, 'image_bytes': 0},
+        {'weight': 3, 'template': 'ctexart', 'body_bytes': 20000,
+         'images': 2, 'image_bytes': 50000},
+        {'weight': 1, 'template': 'article', 'body_bytes': 100000,
+         'images': 8, 'image_bytes': 500000}
+    ]
+}
+TEMPLATES = {
+    'article': {'structure': 'default.structure'},
+    'ctexart': {'structure': 'default.structure'},
+    'default': 'article'
+}
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+REAL_COMPILE_CMD = 'cd {outdir} && xelatex -interaction=batchmode {filepath}'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_png(size, rng):
+    """Make a grayscale noise png of about `size` bytes."""
+    side = max(1, int(size ** 0.5))
+    raw = b''.join(
+        b'\x00' + rng.getrandbits(8 * side).to_bytes(side, 'little')
+        for _ in range(side))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    return b'\x89PNG\r\n\x1a\n' + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', side, side, 8, 0, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw, 1)) + chunk(b'IEND', b'')
+
+
+def make_body(size, image_names, rng):
+    paragraphs = [
+        '\\includegraphics[width=0.3\\textwidth]{%s}' % image_name
+        for image_name in image_names
+    ]
+    length = sum(len(paragraph) for paragraph in paragraphs)
+    while length < size:
+        paragraph = ' '.join(rng.choice(WORDS) for _ in range(80)) + '.'
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    return '\n\n'.join(paragraphs)
+
+
+def load_mix(mix):
+    if mix in MIXES:
+        return MIXES[mix]
+    with open(mix, 'r') as f:
+        return json.load(f)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def wait_until(check, timeout, interval=0.2):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if check():
+                return True
+        except Exception:
+            pass
+        time.sleep(interval)
+    return False
+
+
+def start_mongod(mongod, tmp_dir):
+    """Start a throwaway mongod on a free port.
+
+        Return:
+            (process, mongo uri)
+    """
+    dbpath = os.path.join(tmp_dir, 'db')
+    os.makedirs(dbpath)
+    port = free_port()
+    log = open(os.path.join(tmp_dir, 'mongod.log'), 'w')
+    process = subprocess.Popen(
+        [mongod, '--dbpath', dbpath, '--port', str(port),
+         '--bind_ip', '127.0.0.1'],
+        stdout=log, stderr=subprocess.STDOUT)
+    uri = 'mongodb://127.0.0.1:%d/' % port
+    client = MongoClient(uri, serverSelectionTimeoutMS=500)
+    if not wait_until(lambda: client.admin.command('ping'), 30):
+        process.kill()
+        raise RuntimeError('mongod did not start, see %s' % log.name)
+    client.close()
+    return process, uri
+
+
+def stop(process, timeout=10):
+    """Stop a process and everything in its process group."""
+    if process is None or process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def fake_compile_cmd(args):
+    command = [
+        sys.executable, os.path.join(repo_dir, 'benchmarks', 'fake_tex.py'),
+        '--sleep', str(args.tex_sleep),
+        '--sleep-per-kb', str(args.tex_sleep_per_kb),
+        '--cpu', str(args.tex_cpu),
+        '--size', str(args.pdf_size)
+    ]
+    # compile_cmd is formatted with filepath and outdir
+    return ' '.join(shlex.quote(part).replace('{', '{{').replace('}', '}}')
+                    for part in command) + ' --outdir {outdir} {filepath}'
+
+
+def parse_metrics(text):
+    """Get compiler side Mongo calls and stage means from metrics text."""
+    mongo_calls = {}
+    stages = {}
+    for line in text.splitlines():
+        if line.startswith('#') or ' ' not in line:
+            continue
+        sample, value = line.rsplit(' ', 1)
+        name, _, labels = sample.partition('{')
+        labels = dict(
+            item.split('=', 1) for item in labels.rstrip('}').split(',')
+            if '=' in item)
+        labels = {key: value.strip('"') for key, value in labels.items()}
+        if name == 'anylatex_mongo_seconds_count':
+            key = '%s.%s' % (labels['collection'], labels['operation'])
+            mongo_calls[key] = mongo_calls.get(key, 0) + int(float(value))
+        elif name in ('anylatex_stage_seconds_sum',
+                      'anylatex_stage_seconds_count'):
+            stage = stages.setdefault(labels['stage'], [0.0, 0])
+            stage[0 if name.endswith('_sum') else 1] += float(value)
+    stage_means = {
+        stage: total / count for stage, (total, count) in stages.items()
+        if count
+    }
+    return mongo_calls, stage_means
+
+
+def opcounters(client):
+    return client.admin.command('serverStatus')['opcounters']
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    tmp_dir = tempfile.mkdtemp(prefix='anylatex-bench-')
+    mongod = None
+    monitor = None
+    db_name = 'anylatex_bench_%s' % uuid.uuid4().hex[:8]
+    try:
+        if args.mongo_uri:
+            mongo_uri = args.mongo_uri
+        else:
+            mongod, mongo_uri = start_mongod(args.mongod, tmp_dir)
+        metrics_port = free_port()
+        config = {
+            'mongo_uri': mongo_uri,
+            'db': db_name,
+            'blob_storage': 'filesystem',
+            'blob_dir': os.path.join(tmp_dir, 'blobs'),
+            'compile_cmd': REAL_COMPILE_CMD if args.real_tex
+            else fake_compile_cmd(args),
+            'compile_timeout': args.timeout,
+            'compile_tmp_dir': os.path.join(tmp_dir, 'compiler-tmp'),
+            'compiler_number': args.compilers,
+            'precompile_formats': args.real_tex,
+            'coalesce_window': 0,
+            'user_compile_limit': args.user_limit,
+            'metrics_host': '127.0.0.1',
+            'metrics_port': metrics_port,
+            'templates': TEMPLATES
+        }
+        for setting in args.set:
+            key, value = setting.split('=', 1)
+            config[key] = json.loads(value)
+        config_path = os.path.join(tmp_dir, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump(config, f, indent=4)
+        # models read the config when imported
+        os.environ['ANYLATEX_CONFIG'] = config_path
+        from models.db import DB
+        from models.users import User
+        from models.images import Image
+        from models.tasks import Task
+        from models.events import TaskEvents
+
+        # users, images and task documents are prepared before the run
+        mix = load_mix(args.mix)
+        user_ids = []
+        for _ in range(args.users):
+            user = User()
+            user.create_in_db()
+            user_ids.append(user.user_id)
+        tasks = []
+        for i in range(args.tasks):
+            kind = rng.choices(mix, [k['weight'] for k in mix])[0]
+            user_id = user_ids[i % len(user_ids)]
+            image_names = []
+            for _ in range(kind.get('images', 0)):
+                image = Image(
+                    image_id=uuid.uuid4().hex, user_id=user_id,
+                    content=base64.b64encode(
+                        make_png(kind['image_bytes'], rng)).decode('utf-8'))
+                image.create_in_db()
+                image_names.append(image.image_id + '.png')
+            if args.documents_per_user:
+                document_id = 'doc%d' % rng.randrange(args.documents_per_user)
+            else:
+                document_id = 'doc%d' % i
+            tasks.append(dict(
+                user_id=user_id, document_id=document_id,
+                template=kind['template'], args={}, part_args={},
+                body=make_body(kind['body_bytes'], image_names, rng),
+                images=image_names,
+                priority=kind.get('priority', 'interactive')))
+
+        env = dict(os.environ, PYTHONUNBUFFERED='1')
+        monitor_log = open(os.path.join(tmp_dir, 'monitor.log'), 'w')
+        monitor = subprocess.Popen(
+            [sys.executable, '-m', 'compiler.compiler'], cwd=repo_dir,
+            env=env, stdout=monitor_log, stderr=subprocess.STDOUT,
+            start_new_session=True)
+        metrics_url = 'http://127.0.0.1:%d/metrics' % metrics_port
+        if not wait_until(lambda: urllib.request.urlopen(metrics_url), 60):
+            raise RuntimeError(
+                'compiler did not start, see %s' % monitor_log.name)
+
+        counters_before = None
+        if not args.mongo_uri:
+            counters_before = opcounters(DB.get_client())
+        start_time = time.time()
+        task_ids = []
+        for i, task_args in enumerate(tasks):
+            if args.rate:
+                delay = start_time + i / args.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            task = Task(**task_args)
+            task.create_in_db()
+            TaskEvents.publish(task.task_id, task.status)
+            task_ids.append(task.task_id)
+        object_ids = DB.object_ids(task_ids)
+        completed = wait_until(
+            lambda: DB.count('tasks', {
+                '_id': {'$in': object_ids},
+                'status': {'$in': ['new', 'compiling']}
+            }) == 0,
+            args.deadline)
+        end_time = time.time()
+        counters_after = None
+        if counters_before:
+            counters_after = opcounters(DB.get_client())
+        metrics_text = urllib.request.urlopen(metrics_url).read().decode()
+
+        statuses = {}
+        queue_waits = []
+        totals = []
+        last_finished = start_time
+        for document in DB.find('tasks', {'_id': {'$in': object_ids}},
+                                projection=['status', 'timeline']):
+            status = document.get('status')
+            statuses[status] = statuses.get(status, 0) + 1
+            timeline = document.get('timeline') or {}
+            if 'claimed' in timeline:
+                queue_waits.append(timeline['claimed'] - timeline['submitted'])
+            if status == 'finished' and 'finished' in timeline:
+                totals.append(timeline['finished'] - timeline['submitted'])
+                last_finished = max(last_finished, timeline['finished'])
+        finished = statuses.get('finished', 0)
+        wall_time = last_finished - start_time
+        mongo_calls, stage_means = parse_metrics(metrics_text)
+        result = {
+            'settings': dict(vars(args), compile_cmd=config['compile_cmd']),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count()
+            },
+            'completed': completed,
+            'tasks': len(tasks),
+            'statuses': statuses,
+            'wall_seconds': wall_time,
+            'tasks_per_second': finished / wall_time if wall_time else None,
+            'queue_wait_seconds': {
+                'p50': percentile(queue_waits, 50),
+                'p95': percentile(queue_waits, 95),
+                'p99': percentile(queue_waits, 99)
+            },
+            'end_to_end_seconds': {
+                'p50': percentile(totals, 50),
+                'p95': percentile(totals, 95),
+                'p99': percentile(totals, 99)
+            },
+            'phases': Task.latency_report(start_time - 1)['all'],
+            'stage_mean_seconds': stage_means,
+            'compiler_mongo_calls': mongo_calls,
+            'compiler_mongo_calls_per_task':
+                sum(mongo_calls.values()) / len(tasks),
+            'run_seconds': end_time - start_time
+        }
+        if counters_after:
+            # all ops on the throwaway mongod, submitting tasks included
+            ops = {
+                op: counters_after[op] - counters_before[op]
+                for op in counters_after
+            }
+            result['mongo_ops'] = ops
+            result['mongo_ops_per_task'] = sum(ops.values()) / len(tasks)
+        return result
+    finally:
+        stop(monitor)
+        if args.mongo_uri:
+            client = MongoClient(args.mongo_uri)
+            client.drop_database(db_name)
+            client.close()
+        if mongod:
+            mongod.terminate()
+            mongod.wait()
+        if args.keep:
+            print('Kept files in', tmp_dir)
+        else:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1: %s' % value)
+    return number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=positive_int, default=100)
+    parser.add_argument('--users', type=positive_int, default=10)
+    parser.add_argument('--documents-per-user', type=int, default=0,
+                        help='reuse documents to exercise coalescing, '
+                             '0 for a new document per task')
+    parser.add_argument('--compilers', type=int, default=4)
+    parser.add_argument('--user-limit', type=int, default=2)
+    parser.add_argument('--mix', default='small',
+                        help='%s or a json file of task kinds'
+                             % ', '.join(MIXES))
+    parser.add_argument('--rate', type=float, default=0,
+                        help='tasks submitted per second, 0 for a burst')
+    parser.add_argument('--tex-sleep', type=float, default=0.2)
+    parser.add_argument('--tex-sleep-per-kb', type=float, default=0)
+    parser.add_argument('--tex-cpu', type=float, default=0.05)
+    parser.add_argument('--pdf-size', type=int, default=50*1024)
+    parser.add_argument('--real-tex', action='store_true',
+                        help='compile with xelatex instead of fake_tex.py')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='compile timeout')
+    parser.add_argument('--deadline', type=float, default=600,
+                        help='seconds to wait for all tasks')
+    parser.add_argument('--mongod', default='mongod')
+    parser.add_argument('--mongo-uri', default=None,
+                        help='use a temporary database on this server '
+                             'instead of starting mongod')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=JSON', help='override a config key')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the temporary directory and logs')
+    args = parser.parse_args(argv)
+    result = run(args)
+    body = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(body + '\n')
+    else:
+        print(body)
+    print('%d tasks, %.2f tasks/s, end to end p50 %s p95 %s' % (
+        result['tasks'], result['tasks_per_second'] or 0,
+        result['end_to_end_seconds']['p50'],
+        result['end_to_end_seconds']['p95']), file=sys.stderr)
+    return 0 if result['completed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+# coding: utf-8
+
+import os
+import time
+import hashlib
+
+from models.cache import CacheEntry
+from models.model import ModelError
+
+
+def file_hash(path):
+    """Get sha256 hex digest of a file's content."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class CompileCache:
+
+    """Content addressed cache of compiled PDFs.
+
+        A key is the hash of everything a LaTeX run reads: the rendered
+        document, the template's assets and the images' content hashes.
+        Tasks with the same key reuse the PDF compiled for the first one.
+
+    """
+
+    def __init__(self, max_entries=10000, ttl=7*24*3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(user_id, latex, asset_paths=(), image_hashes={},
+                 compile_cmd=''):
+        """Hash compile inputs into a cache key.
+
+            Keys are scoped per user so a hit never hands out a PDF
+            compiled for someone else.
+
+        """
+        h = hashlib.sha256()
+        for part in (user_id, compile_cmd, latex):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        for path in asset_paths:
+            if path and os.path.isfile(path):
+                h.update(os.path.basename(path).encode('utf-8'))
+                h.update(file_hash(path).encode('utf-8'))
+        for image_name in sorted(image_hashes):
+            h.update(image_name.encode('utf-8'))
+            h.update(image_hashes[image_name].encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        """Get cached pdf id of this key, or None on a miss."""
+        entry = CacheEntry(key=key)
+        try:
+            entry.load_from_db()
+        except ModelError:
+            self.misses += 1
+            return None
+        now = time.time()
+        if now - entry.created_time > self.ttl:
+            try:
+                entry.delete_in_db()
+                self.evictions += 1
+            except ModelError:
+                # removed by an eviction or another compiler meanwhile
+                pass
+            self.misses += 1
+            return None
+        entry.last_used = now
+        try:
+            entry.update_to_db()
+        except ModelError:
+            # evicted since loaded, its pdf may be gone too
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.pdf_id
+
+    def put(self, key, pdf_id):
+        """Cache a compiled pdf's id under this key."""
+        entry = CacheEntry(key=key, pdf_id=pdf_id)
+        try:
+            entry.create_in_db()
+        except Exception as e:
+            # another compiler has cached the same inputs
+            print('Fail to cache compile result', key, 'Error: ', e)
+
+    def evict(self):
+        """Remove expired entries and keep at most `max_entries`."""
+        evicted = CacheEntry.delete_expired(time.time() - self.ttl)
+        evicted += CacheEntry.delete_least_recently_used(self.max_entries)
+        self.evictions += evicted
+        return evicted
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0
+        }
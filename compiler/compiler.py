@@ -1,56 +1,151 @@
 # coding: utf-8
 
 import os
+import uuid
+import socket
 import time
-import base64
-import shutil
+import queue
+import signal
+import threading
+import collections
 import subprocess
 import multiprocessing
-from string import Template
+from contextlib import closing
 
+from models.db import DB
 from models.users import User
 from models.pdfs import PDF
 from models.images import Image
 from models.tasks import Task
+from models.events import TaskEvents, TaskEventListener
+from models.metrics import Metrics, serve_metrics
+from models.admission import CompilerStats
+from models.indexes import ensure_indexes
+from .cache import CompileCache
+from .workspace import WorkspaceManager
+from .templates import TemplateRegistry
+from .scheduler import FairScheduler
+from .formats import FormatCache, DEFAULT_FORMAT_CMD
 
 
 class LatexCompiler(multiprocessing.Process):
 
     """Compiler for compiling LaTex documents.
 
-        Finish task object will have a `pdf_id` attribute.
+        Compilers store pdfs themselves and only send small results
+        (see `Task.result`) back, a compiled result has a `pdf_id`.
+
+        Compile commands run in their own process group, the monitor
+        kills the group through `cancel` when the task is deleted or
+        superseded.
+
+        Metrics observed in a compiler are sent with its results and
+        replayed by the monitor.
+
+        A compiler connects to the db with its own small pool of
+        `mongo_pool_size` connections.
 
     """
 
-    def __init__(self, structure_dir, template_configs, temp_dir, compile_cmd, compile_timeout, task_queue, result_queue, name="Compiler"):
+    def __init__(self, templates, workspaces, compile_cmd, compile_timeout, task_queue, result_queue, cache, formats=None, mongo_pool_size=2, workspace_wait=10, name="Compiler"):
         multiprocessing.Process.__init__(self, name=name)
-        self.structure_dir = structure_dir
-        self.template_configs = template_configs
-        # converting to real path
-        self.temp_dir = os.path.realpath(temp_dir)
+        self.templates = templates
+        self.workspaces = workspaces
         self.compile_cmd = compile_cmd
         self.compile_timeout = compile_timeout
         self.task_queue = task_queue
         self.result_queue = result_queue
+        self.cache = cache
+        self.formats = formats
+        self.mongo_pool_size = mongo_pool_size
+        self.workspace_wait = workspace_wait
+        # compiling task shared with the monitor
+        self.state_lock = multiprocessing.Lock()
+        self.compiling_task = multiprocessing.Array('c', 32)
+        self.compiling_pgid = multiprocessing.Value('i', 0, lock=False)
+        self.cancelled = multiprocessing.Value('b', False, lock=False)
+
+    def set_compiling_task(self, task_id):
+        with self.state_lock:
+            self.compiling_task.value = task_id.encode('utf-8')
+            self.cancelled.value = False
+
+    def cancel(self, task_id):
+        """Kill the compile of this task if running, called by the monitor.
+
+            Return True if the task is being compiled by this compiler.
+        """
+        with self.state_lock:
+            if self.compiling_task.value.decode('utf-8') != task_id:
+                return False
+            self.cancelled.value = True
+            if self.compiling_pgid.value:
+                try:
+                    os.killpg(self.compiling_pgid.value, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        return True
+
+    def run_compile(self, command):
+        """Run a compile command in a new process group.
+
+            Return False if the task is cancelled.
+        """
+        with self.state_lock:
+            if self.cancelled.value:
+                return False
+            process = subprocess.Popen(
+                command, shell=True, start_new_session=True)
+            self.compiling_pgid.value = process.pid
+        try:
+            process.wait(timeout=self.compile_timeout)
+        except subprocess.TimeoutExpired:
+            # kill everything the command started
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            raise
+        finally:
+            with self.state_lock:
+                self.compiling_pgid.value = 0
+        return not self.cancelled.value
+
+    def put_result(self, task_result):
+        """Send a result with metrics observed since the last one."""
+        self.result_queue.put((task_result, Metrics.drain()))
 
     def run(self):
+        Metrics.buffer_observations()
+        DB.configure(maxPoolSize=self.mongo_pool_size, minPoolSize=0)
         while True:
             task = self.task_queue.get()
-            print(self.name, 'starts', 'processing task:', task.task_id)
-            # create temp directory
-            compile_tmp_dir = os.path.join(
-                self.temp_dir, task.user_id + task.document_id)
-            if not os.path.exists(compile_tmp_dir):
-                os.mkdir(compile_tmp_dir)
-            filename = task.document_id + '.tex'
-            filepath = os.path.join(compile_tmp_dir, filename)
-            pdfname = task.document_id + '.pdf'
-            pdfpath = os.path.join(compile_tmp_dir, pdfname)
-            # get structure document path
-            structure = self.template_configs[task.template]['structure']
-            structure_path = os.path.join(self.structure_dir, structure)
-            with open(structure_path, 'r') as f:
-                structure_t = Template(f.read())
+            try:
+                self.process_task(task)
+            except Exception as e:
+                # e.g. the db or the template is unavailable
+                print(self.name, 'fails to process task:', task.task_id,
+                      'Error: ', e)
+                self.put_result(task.result(status='failed'))
+            finally:
+                self.set_compiling_task('')
+
+    def process_task(self, task):
+        """Compile a claimed task and send its result."""
+        # tasks deleted or superseded while queued are skipped
+        if not task.is_compiling():
+            print(self.name, 'skips', 'task:', task.task_id)
+            self.put_result(task.result(status='cancelled'))
+            return
+        self.set_compiling_task(task.task_id)
+        print(self.name, 'starts', 'processing task:', task.task_id)
+        filename = task.document_id + '.tex'
+        pdfname = task.document_id + '.pdf'
+        fmt_filename = task.document_id + '-fmt.tex'
+        fmt_pdfname = task.document_id + '-fmt.pdf'
+        stage = dict(template=task.template)
+        # get the parsed structure document, reloaded if changed
+        with Metrics.timer('anylatex_stage_seconds', stage='render',
+                           **stage):
+            structure = self.templates.structure(task.template)
             # get template's arguments
             args = task.args
             print(args)
@@ -63,72 +158,190 @@ class LatexCompiler(multiprocessing.Process):
             if part_args:
                 for arg, value in part_args.items():
                     sub_dict[arg] = value
-            latex = structure_t.substitute(sub_dict)
-            # fetch images in DB and save them to the compiling directory
-            print(task.images)
-            for image_name in task.images:
-                image_id, image_type = image_name.split('.')
-                image = Image(image_id=image_id, user_id=task.user_id)
-                try:
-                    image.load_from_db()
-                except Exception as e:
-                    print(e)
+            latex = structure.substitute(sub_dict)
+        # fetch images' metadata in DB
+        image_ids = {}
+        for image_name in task.images:
+            image_id, image_type = image_name.split('.')
+            image_ids[image_name] = image_id
+        try:
+            with Metrics.timer('anylatex_stage_seconds', stage='images',
+                               **stage):
+                found_images = Image.find_for_user(
+                    task.user_id, image_ids.values())
+        except Exception as e:
+            print(e)
+            found_images = {}
+        images = {}
+        for image_name, image_id in image_ids.items():
+            if image_id not in found_images:
+                print('No image', image_id, 'of user', task.user_id)
+                continue
+            images[image_name] = found_images[image_id]
+        # skip compiling if the same inputs have been compiled
+        cls_path = self.templates.config(task.template).get('cls_path')
+        with Metrics.timer('anylatex_stage_seconds', stage='cache',
+                           **stage):
+            cache_key = self.cache.make_key(
+                task.user_id, latex,
+                asset_paths=[structure.path, cls_path],
+                image_hashes={
+                    image_name: image.content_hash()
+                    for image_name, image in images.items()
+                },
+                compile_cmd=self.compile_cmd
+            )
+            pdf_id = self.cache.get(cache_key)
+        Metrics.inc('anylatex_compile_cache_total',
+                    result='hit' if pdf_id else 'miss')
+        print(self.name, 'compile cache:', self.cache.stats())
+        if pdf_id:
+            self.put_result(task.result(pdf_id=pdf_id))
+            print(self.name, 'reuses cached pdf for task:', task.task_id)
+            return
+        # get the document's workspace, auxiliary files of the last
+        # compile are kept unless the template changes
+        # a superseded compile of the document is killed soon, it is
+        # waited for `workspace_wait` seconds at most
+        compile_tmp_dir = self.workspaces.acquire(
+            task.user_id, task.document_id,
+            fingerprint=task.template + ':' + structure.name,
+            owner=task.task_id, wait=self.workspace_wait
+        )
+        if not compile_tmp_dir:
+            print(self.name, 'fails to lock workspace of task:',
+                  task.task_id)
+            self.put_result(task.result(status='failed'))
+            return
+        filepath = os.path.join(compile_tmp_dir, filename)
+        pdfpath = os.path.join(compile_tmp_dir, pdfname)
+        try:
+            inputs_start = time.time()
+            # save changed images to the compiling directory
+            for image_name, image in images.items():
+                if self.workspaces.is_current(
+                        compile_tmp_dir, image_name, image.content_hash()):
                     continue
-                image_content = base64.b64decode(image.content.encode())
-                image_path = os.path.join(compile_tmp_dir, image_name)
-                with open(image_path, 'wb') as f:
-                    f.write(image_content)
+                with closing(image.open_content()) as f:
+                    self.workspaces.write_stream(
+                        compile_tmp_dir, image_name, f, image.content_hash())
             # move cls to compile dir if exists
-            cls_path = self.template_configs[task.template].get('cls_path')
             if cls_path:
-                shutil.copy(
-                    cls_path,
-                    os.path.join(compile_tmp_dir, os.path.split(cls_path)[-1])
-                )
+                self.workspaces.copy_file(compile_tmp_dir, cls_path)
             # write tex file
-            with open(filepath, 'w') as f:
-                f.write(latex)
-            # start compiling
-            try:
-                command = self.compile_cmd.format(
-                    filepath=filepath,
-                    outdir=compile_tmp_dir
+            self.workspaces.write_file(compile_tmp_dir, filename, latex)
+            self.workspaces.remove_outputs(
+                compile_tmp_dir, [pdfname, fmt_pdfname])
+            task.stamp('inputs')
+            command = self.compile_cmd.format(
+                filepath=filepath,
+                outdir=compile_tmp_dir
+            )
+            # start from the template's precompiled preamble if usable
+            fmt_latex = None
+            if self.formats:
+                fmt_name, static = self.formats.prepare(
+                    task.template, structure.name, structure.text, cls_path,
+                    runner=self.run_command
                 )
-                subprocess.run(
-                    command,
-                    shell=True,
-                    timeout=self.compile_timeout
+                if fmt_name:
+                    fmt_latex = self.formats.apply(
+                        fmt_name, static, latex)
+            if fmt_latex:
+                self.formats.link(fmt_name, compile_tmp_dir)
+                self.workspaces.write_file(
+                    compile_tmp_dir, fmt_filename, fmt_latex)
+                command = self.formats.command(
+                    self.compile_cmd,
+                    os.path.join(compile_tmp_dir, fmt_filename),
+                    filepath, pdfpath, compile_tmp_dir
                 )
-                # read pdf content and parsed into b64 string
-                with open(pdfpath, 'rb') as f:
-                    pdf_content = f.read()
-                pdf_b64 = base64.b64encode(pdf_content).decode('utf-8')
-                # put into result queue
-                task.pdf_b64 = pdf_b64
-                self.result_queue.put(task)
-            except subprocess.TimeoutExpired as e:
-                print("Compile timeout: ", e)
-            finally:
-                # cleanup tmp files
-                # shutil.rmtree(compile_tmp_dir)
-                print(self.name, 'end', 'processing task:', task.task_id)
+            Metrics.observe('anylatex_stage_seconds',
+                            time.time() - inputs_start, stage='inputs',
+                            **stage)
+            # start compiling
+            task.stamp('tex_started')
+            with Metrics.timer('anylatex_stage_seconds', stage='tex',
+                               **stage):
+                compiled = self.run_compile(command)
+            task.stamp('tex_finished')
+            if not compiled:
+                print(self.name, 'cancels', 'task:', task.task_id)
+                # outputs of a killed compile may be broken
+                if self.workspaces.owns(compile_tmp_dir, task.task_id):
+                    self.workspaces.clear(compile_tmp_dir)
+                self.put_result(task.result(status='cancelled'))
+                return
+            # stream the pdf into the blob storage, only its id is
+            # sent to the monitor
+            with Metrics.timer('anylatex_stage_seconds', stage='store',
+                               **stage):
+                pdf_id = self.store_pdf(task, pdfpath, cache_key)
+            task.stamp('stored')
+            self.put_result(task.result(pdf_id=pdf_id))
+        except subprocess.TimeoutExpired as e:
+            print("Compile timeout: ", e)
+            self.put_result(task.result(status='failed'))
+        except FileNotFoundError as e:
+            print("No pdf generated: ", e)
+            self.put_result(task.result(status='failed'))
+        except Exception as e:
+            print("Fail to store pdf: ", e)
+            self.put_result(task.result(status='failed'))
+        finally:
+            self.set_compiling_task('')
+            # keep the workspace for the next compile
+            self.workspaces.release(compile_tmp_dir, task.task_id)
+            print(self.name, 'end', 'processing task:', task.task_id)
+
+    def store_pdf(self, task, pdfpath, cache_key):
+        """Save a compiled pdf and cache it.
+
+            Return:
+                pdf's id
+        """
+        compiled_time = str(int(time.time()))
+        pdf = PDF(user_id=task.user_id, compiled_time=compiled_time)
+        with open(pdfpath, 'rb') as f:
+            pdf.save_content(f)
+        pdf.create_in_db()
+        self.cache.put(cache_key, pdf.pdf_id)
+        return pdf.pdf_id
+
+    def run_command(self, command):
+        try:
+            subprocess.run(command, shell=True, timeout=self.compile_timeout)
+        except subprocess.TimeoutExpired as e:
+            print("Command timeout: ", e)
 
 
 class TaskMonitor:
 
     """Monitor of processing uncompiled tasks in db."""
 
-    def __init__(self, structure_dir='', templates={},
+    def __init__(self, structure_dir='', templates={}, config_path=None,
                  compile_cmd=None, compile_timeout=300,
                  compile_tmp_dir='compiler-tmp',
-                 compiler_number=None, db_scan_interval=1, **other):
+                 compiler_number=None, db_scan_interval=1,
+                 cache_max_entries=10000, cache_ttl=7*24*3600,
+                 cache_evict_interval=60, workspace_max_bytes=5*1024**3,
+                 precompile_formats=True, format_cmd=DEFAULT_FORMAT_CMD,
+                 format_retry_interval=3600, event_driven=True,
+                 fallback_scan_interval=30, max_compiled_pdfs=1000,
+                 coalesce_window=0,
+                 running_policy='wait', priority_weights=None,
+                 user_compile_limit=2, lease_time=60, max_attempts=3,
+                 metrics_host='127.0.0.1', metrics_port=None,
+                 compiler_mongo_pool_size=2, **other):
         self.name = self.__class__.__name__
         # compiler settings
         if not structure_dir:
             structure_dir = os.path.dirname(os.path.realpath(__file__))
             structure_dir = os.path.join(structure_dir, 'structures')
         self.structure_dir = structure_dir
-        self.template_configs = templates
+        # templates are reloaded from `config_path` when it changes
+        self.templates = TemplateRegistry(
+            structure_dir, config_path=config_path, templates=templates)
         if not compiler_number:
             compiler_number = multiprocessing.cpu_count()
         self.compiler_number = compiler_number
@@ -137,94 +350,318 @@ class TaskMonitor:
         self.compile_cmd = compile_cmd
         self.compile_timeout = compile_timeout
         self.compile_tmp_dir = compile_tmp_dir
-        if not os.path.exists(self.compile_tmp_dir):
-            os.mkdir(self.compile_tmp_dir)
+        self.workspaces = WorkspaceManager(
+            compile_tmp_dir, workspace_max_bytes, 2 * compile_timeout)
+        self.formats = None
+        if precompile_formats:
+            self.formats = FormatCache(
+                os.path.join(self.workspaces.root, '.formats'), format_cmd,
+                format_retry_interval)
         # other settings
-        self.db_scan_interval = db_scan_interval
+        self.event_driven = event_driven
+        self.scan_interval = db_scan_interval
+        if event_driven:
+            self.scan_interval = fallback_scan_interval
+        self.wakeup = threading.Event()
         self.task_queue = multiprocessing.Queue()
         self.result_queue = multiprocessing.Queue()
+        # compile results cache
+        self.cache = CompileCache(cache_max_entries, cache_ttl)
+        self.cache_evict_interval = cache_evict_interval
+        self.last_evict_time = 0
+        # users only keep their latest compiled pdfs
+        self.max_compiled_pdfs = max_compiled_pdfs
+        # new tasks of a document within the window are compiled once,
+        # a running compile of it is waited for or preempted
+        self.coalesce_window = coalesce_window
+        self.running_policy = running_policy
+        # claimed tasks are leased to this monitor and renewed by
+        # heartbeats, tasks of dead monitors are compiled again
+        self.owner = '%s:%d:%s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.last_reclaim_time = 0
+        # users share compilers fairly by priority class
+        self.scheduler = FairScheduler(
+            priority_weights, user_compile_limit,
+            coalesce_window, running_policy,
+            owner=self.owner, lease_time=lease_time)
         # child processes
         self.compilers = None
+        # ids of claimed tasks not committed yet
+        self.owned = set()
+        # metrics are served on this port if set
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.compiler_mongo_pool_size = compiler_mongo_pool_size
+        # recent seconds from claim to finish, published with the load
+        # for the api's admission control
+        self.service_times = collections.deque(maxlen=100)
 
     def scan(self):
-        results = Task.find_all()
-        compile_tasks = []
-        for result in results:
-            task = Task(**result)
-            if task.status == 'new':
-                compile_tasks.append(task)
-                task.status = 'compiling'
-                task.update_to_db()
-            elif task.status == "compiling":
-                pass
-            elif task.status == "finished":
-                pass
-            else:
-                print("unknown task's status:", task.status)
-        return compile_tasks
+        """Claim new tasks to keep every compiler busy."""
+        limit = max(0, self.compiler_number - self.task_queue.qsize())
+        tasks, superseded = self.scheduler.schedule(limit)
+        for task in tasks + superseded:
+            self.notify(task)
+        Metrics.inc('anylatex_tasks_total', len(superseded),
+                    status='superseded')
+        return tasks
+
+    def notify(self, task):
+        """Publish the task's status to waiting clients."""
+        try:
+            TaskEvents.publish(
+                task.task_id, task.status,
+                pdf_id=getattr(task, 'pdf_id', None),
+                superseded_by=getattr(task, 'superseded_by', None))
+        except Exception as e:
+            print('Fail to publish task', task.task_id, 'Error: ', e)
+
+    def save_status(self, task):
+        """Save a compiled task's status and pdf, the task is left alone if
+        it is deleted, no longer compiling or its lease is lost."""
+        condition = {'status': 'compiling', 'owner': self.owner}
+        task.stamp('finished')
+        if task.update_to_db(condition=condition):
+            Metrics.inc('anylatex_tasks_total', status=task.status)
+            if task.status == 'finished' and 'claimed' in task.timeline:
+                self.service_times.append(
+                    task.timeline['finished'] - task.timeline['claimed'])
+            self.notify(task)
+        else:
+            print('Task', task.task_id, 'is no longer compiling')
 
     def process_result(self, task_result):
+        """Check a compiler's result.
+
+            Return True if the task is compiled and should be committed
+            by `commit_results`.
+        """
         print(self.name, 'starts', 'processing result:', task_result.task_id)
-        # get pdf b64 string and put into db
-        pdf_b64 = task_result.pdf_b64
-        delattr(task_result, 'pdf_b64')
-        compiled_time = str(int(time.time()))
-        pdf = PDF(data=pdf_b64, compiled_time=compiled_time)
-        pdf.create_in_db()
-        task_result.pdf_id = pdf.pdf_id
-        user = User(user_id=task_result.user_id)
-        user.load_from_db()
-        user.compiled_pdfs.append(pdf.pdf_id)
-        user.update_to_db()
-        # update task into task
-        task_result.status = "finished"
-        task_result.update_to_db()
-        # delete task.Canceled, task will be deleted by client's request
-        # task_result.delete_in_db()
-        print(self.name, 'ends', 'processing result:', task_result.task_id)
+        if task_result.status == 'cancelled':
+            # the task is deleted or superseded, nothing to save
+            print(self.name, 'cancelled', 'task:', task_result.task_id)
+            Metrics.inc('anylatex_tasks_total', status='cancelled')
+            return False
+        if task_result.status == 'failed':
+            self.save_status(task_result)
+            print(self.name, 'fails', 'processing task:', task_result.task_id)
+            return False
+        return True
+
+    def commit_results(self, tasks):
+        """Add compiled tasks' pdfs to users' lists in one bulk write and
+        mark the tasks finished."""
+        if not tasks:
+            return
+        commit_start = time.time()
+        try:
+            User.add_compiled_pdfs(
+                [(task.user_id, task.pdf_id) for task in tasks],
+                self.max_compiled_pdfs)
+        except Exception as e:
+            # the tasks are finished anyway, their pdfs are stored
+            print('Fail to add compiled pdfs to users', 'Error: ', e)
+        for task in tasks:
+            task.status = "finished"
+            try:
+                self.save_status(task)
+            except Exception as e:
+                print('Fail to save task', task.task_id, 'Error: ', e)
+            # delete task.Canceled, task will be deleted by client's request
+            # task.delete_in_db()
+            print(self.name, 'ends', 'processing result:', task.task_id)
+        Metrics.observe('anylatex_commit_seconds', time.time() - commit_start)
 
     def start(self):
+        DB.warmup()
+        ensure_indexes()
         print('Creating {} latex compilers'.format(self.compiler_number))
         self.compilers = [
-            LatexCompiler(
-                self.structure_dir,
-                self.template_configs,
-                self.compile_tmp_dir,
-                self.compile_cmd,
-                self.compile_timeout,
-                self.task_queue,
-                self.result_queue,
-                name='Compiler '+str(i))
-            for i in range(self.compiler_number)
+            self.create_compiler(i) for i in range(self.compiler_number)
         ]
         for c in self.compilers:
             c.start()
 
+        # kill cancelled compiles, and if event driven wake up on new
+        # tasks and finished compiles, scan the db anyway every
+        # `scan_interval` in case a notification is lost
+        TaskEventListener(self.on_task_event).start()
+        threading.Thread(
+            target=self.process_results, name='ResultProcessor', daemon=True
+        ).start()
+        threading.Thread(
+            target=self.keep_leases, name='LeaseKeeper', daemon=True
+        ).start()
+        CompilerStats.remove_stale()
+        threading.Thread(
+            target=self.publish_stats, name='StatsPublisher', daemon=True
+        ).start()
+        Metrics.add_collector(self.collect_metrics)
+        if self.metrics_port:
+            try:
+                serve_metrics(self.metrics_host, self.metrics_port)
+            except OSError as e:
+                # e.g. taken by another monitor on this host
+                print('Fail to serve metrics on port', self.metrics_port,
+                      'Error: ', e)
+
         while True:
+            self.wakeup.wait(self.wait_time())
+            self.wakeup.clear()
+            self.check_compilers()
+            self.reclaim()
             # scan tasks in db and put into task queue
             compile_tasks = self.scan()
             for task in compile_tasks:
+                self.owned.add(task.task_id)
                 self.task_queue.put(task)
-            # process finished tasks' result
-            for check_time in range(self.compiler_number):
-                try:
-                    task_result = self.result_queue.get(block=False)
-                    self.process_result(task_result)
-                except multiprocessing.queues.Empty:
-                    pass
+            # evict expired and least recently used cache entries
+            if time.time() - self.last_evict_time > self.cache_evict_interval:
+                self.last_evict_time = time.time()
+                print('Evicted cache entries:', self.cache.evict())
+                print('Evicted workspaces:', self.workspaces.evict())
+                print('Scheduler:', self.scheduler.stats())
             # monitor result queue and task queue
             print('Task queue size:', self.task_queue.qsize())
             print('Result queue size:', self.result_queue.qsize())
-            time.sleep(self.db_scan_interval)
+
+    def create_compiler(self, i):
+        return LatexCompiler(
+            self.templates,
+            self.workspaces,
+            self.compile_cmd,
+            self.compile_timeout,
+            self.task_queue,
+            self.result_queue,
+            self.cache,
+            self.formats,
+            mongo_pool_size=self.compiler_mongo_pool_size,
+            name='Compiler '+str(i))
+
+    def check_compilers(self):
+        """Replace dead compilers, their tasks are left to lease expiry."""
+        for i, compiler in enumerate(self.compilers):
+            if compiler.is_alive():
+                continue
+            task_id = compiler.compiling_task.value.decode('utf-8')
+            print(compiler.name, 'died', 'with task:', task_id)
+            self.owned.discard(task_id)
+            self.compilers[i] = self.create_compiler(i)
+            self.compilers[i].start()
+
+    def owned_tasks(self):
+        return list(self.owned)
+
+    def reclaim(self):
+        """Compile again tasks whose owners stopped renewing leases."""
+        if time.time() - self.last_reclaim_time < self.lease_time / 2:
+            return
+        self.last_reclaim_time = time.time()
+        retried, failed = Task.reclaim_expired(self.max_attempts)
+        for task in retried + failed:
+            print('Reclaimed task', task.task_id, 'status:', task.status)
+            self.notify(task)
+        Metrics.inc('anylatex_tasks_total', len(retried), status='retried')
+        Metrics.inc('anylatex_tasks_total', len(failed), status='failed')
+
+    def keep_leases(self):
+        """Renew leases of owned tasks until the monitor exits."""
+        while True:
+            time.sleep(self.lease_time / 3)
+            try:
+                Task.renew_leases(
+                    self.owner, self.owned_tasks(), self.lease_time)
+            except Exception as e:
+                print('Fail to renew leases', 'Error: ', e)
+
+    def publish_stats(self, interval=1):
+        """Report this monitor's load every `interval` seconds until the
+        monitor exits."""
+        while True:
+            time.sleep(interval)
+            service_times = list(self.service_times)
+            try:
+                CompilerStats.publish(
+                    self.owner, self.compiler_number,
+                    len(self.owned_tasks()), self.scheduler.refresh_pending(),
+                    sum(service_times) / len(service_times)
+                    if service_times else None)
+            except Exception as e:
+                print('Fail to publish stats', 'Error: ', e)
+
+    def collect_metrics(self):
+        """Update gauges of compilers and queues before a scrape."""
+        compilers = self.compilers or []
+        busy = sum(1 for compiler in compilers
+                   if compiler.compiling_task.value)
+        Metrics.set('anylatex_workers', busy, state='busy')
+        Metrics.set('anylatex_workers', len(compilers) - busy, state='idle')
+        Metrics.set('anylatex_task_queue_depth', self.task_queue.qsize(),
+                    queue='task')
+        Metrics.set('anylatex_task_queue_depth', self.result_queue.qsize(),
+                    queue='result')
+
+    def wait_time(self):
+        """Get seconds to wait for the next scan, debounced tasks are
+        claimed as soon as their window passes."""
+        timeout = self.scan_interval
+        if self.coalesce_window:
+            next_claim_time = Task.next_claim_time(self.coalesce_window)
+            if next_claim_time is not None:
+                timeout = min(timeout, max(next_claim_time - time.time(), 0))
+        return timeout
+
+    def on_task_event(self, event):
+        if event['status'] == 'new':
+            if self.event_driven:
+                self.wakeup.set()
+        elif event['status'] in ('cancelled', 'superseded'):
+            self.cancel(event['task_id'])
+
+    def cancel(self, task_id):
+        """Kill a deleted or superseded task's running compile."""
+        for compiler in self.compilers or []:
+            if compiler.cancel(task_id):
+                print('Cancelled task', task_id, 'in', compiler.name)
+
+    def process_results(self):
+        """Process finished tasks' results as soon as they arrive."""
+        while True:
+            # results arrived at the same time are committed together
+            items = [self.result_queue.get()]
+            while True:
+                try:
+                    items.append(self.result_queue.get_nowait())
+                except queue.Empty:
+                    break
+            task_results = []
+            for task_result, observations in items:
+                Metrics.replay(observations)
+                task_results.append(task_result)
+            compiled_tasks = []
+            for task_result in task_results:
+                try:
+                    if self.process_result(task_result):
+                        compiled_tasks.append(task_result)
+                except Exception as e:
+                    print('Fail to process result', task_result.task_id,
+                          'Error: ', e)
+            try:
+                self.commit_results(compiled_tasks)
+            except Exception as e:
+                print('Fail to commit results', 'Error: ', e)
+            for task_result in task_results:
+                self.owned.discard(task_result.task_id)
+            # compilers become idle
+            self.wakeup.set()
 
 
 if __name__ == '__main__':
-    import json
-    config_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-    config_path = os.path.join(config_path, 'config.json')
-    with open(config_path, 'r') as f:
-        config = json.load(f)
+    from models.db import config, config_path
 
-    t = TaskMonitor(**config)
+    t = TaskMonitor(config_path=config_path, **config)
     t.start()
 
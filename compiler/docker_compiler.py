@@ -1,28 +1,54 @@
 # coding: utf-8
 
 import os
+import uuid
+import socket
 import time
-import base64
-import shutil
+import queue
 import docker
-from string import Template
+import threading
+import collections
+from contextlib import closing
 
+from models.db import DB
 from models.users import User
 from models.pdfs import PDF
 from models.images import Image
 from models.tasks import Task
+from models.events import TaskEvents, TaskEventListener
+from models.metrics import Metrics, serve_metrics
+from models.admission import CompilerStats
+from models.indexes import ensure_indexes
+from .cache import CompileCache
+from .workspace import WorkspaceManager
+from .templates import TemplateRegistry
+from .scheduler import FairScheduler
+from .formats import FormatCache, DEFAULT_FORMAT_CMD
 
 
 class TaskMonitor:
 
     """Monitor of processing uncompiled tasks in db."""
 
+    # compile script and its process group id in a workspace
+    script_name = '.compile.sh'
+    pid_name = '.compile.pid'
+
     def __init__(self, docker_socket_path,
                  texlive_docker_image,
                  compiler_docker_volume,
-                 structure_dir='', templates={},
+                 structure_dir='', templates={}, config_path=None,
                  compile_cmd=None, compile_tmp_dir='/compiler-tmp',
-                 compiler_number=None, db_scan_interval=1, **other):
+                 compiler_number=None, db_scan_interval=1,
+                 cache_max_entries=10000, cache_ttl=7*24*3600,
+                 cache_evict_interval=60, workspace_max_bytes=5*1024**3,
+                 compile_timeout=300, precompile_formats=True,
+                 format_cmd=DEFAULT_FORMAT_CMD, format_retry_interval=3600,
+                 event_driven=True, fallback_scan_interval=30,
+                 max_compiled_pdfs=1000, coalesce_window=0,
+                 running_policy='wait', priority_weights=None,
+                 user_compile_limit=2, lease_time=60, max_attempts=3,
+                 metrics_host='127.0.0.1', metrics_port=None, **other):
         self.name = self.__class__.__name__
         self.docker_client = docker.from_env()
         self.texlive_docker_image = texlive_docker_image
@@ -32,7 +58,9 @@ class TaskMonitor:
             structure_dir = os.path.dirname(os.path.realpath(__file__))
             structure_dir = os.path.join(structure_dir, 'structures')
         self.structure_dir = structure_dir
-        self.template_configs = templates
+        # templates are reloaded from `config_path` when it changes
+        self.templates = TemplateRegistry(
+            structure_dir, config_path=config_path, templates=templates)
         if not compiler_number:
             compiler_number = os.cpu_count()
         self.compiler_number = compiler_number
@@ -40,32 +68,79 @@ class TaskMonitor:
             raise ValueError("no compile command provided.")
         self.compile_cmd = compile_cmd
         self.compile_tmp_dir = compile_tmp_dir
-        if not os.path.exists(self.compile_tmp_dir):
-            os.mkdir(self.compile_tmp_dir)
+        self.workspaces = WorkspaceManager(
+            compile_tmp_dir, workspace_max_bytes, 2 * compile_timeout)
+        # formats are shared with containers through the compiler volume
+        self.formats = None
+        if precompile_formats:
+            self.formats = FormatCache(
+                os.path.join(self.workspaces.root, '.formats'), format_cmd,
+                format_retry_interval)
         # other settings
-        self.db_scan_interval = db_scan_interval
+        self.event_driven = event_driven
+        self.scan_interval = db_scan_interval
+        if event_driven:
+            self.scan_interval = fallback_scan_interval
+        self.wakeup = threading.Event()
+        self.finished_containers = queue.Queue()
         self.compiling_containers = {}
         self.compilers = []
+        # compiled tasks committed at the end of a loop
+        self.compiled_tasks = []
+        # claimed tasks waiting for a superseded compile of their
+        # document to release the workspace
+        self.waiting_tasks = []
+        # users only keep their latest compiled pdfs
+        self.max_compiled_pdfs = max_compiled_pdfs
+        # new tasks of a document within the window are compiled once,
+        # a running compile of it is waited for or preempted
+        self.coalesce_window = coalesce_window
+        self.running_policy = running_policy
+        # claimed tasks are leased to this monitor and renewed by
+        # heartbeats, tasks of dead monitors are compiled again
+        self.owner = '%s:%d:%s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.last_reclaim_time = 0
+        # users share compilers fairly by priority class
+        self.scheduler = FairScheduler(
+            priority_weights, user_compile_limit,
+            coalesce_window, running_policy,
+            owner=self.owner, lease_time=lease_time)
+        # compile results cache
+        self.cache = CompileCache(cache_max_entries, cache_ttl)
+        self.cache_evict_interval = cache_evict_interval
+        self.last_evict_time = 0
+        # metrics are served on this port if set
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        # recent seconds from claim to finish, published with the load
+        # for the api's admission control
+        self.service_times = collections.deque(maxlen=100)
 
-    def scan(self):
-        results = Task.find_all()
-        compile_tasks = []
-        for result in results:
-            task = Task(**result)
-            if task.status == 'new':
-                compile_tasks.append(task)
-            elif task.status == "compiling":
-                pass
-            elif task.status == "finished":
-                pass
-            elif task.status == "failed":
-                # TODO
-                pass
-            else:
-                print("unknown task's status:", task.status)
-        return compile_tasks
+    def scan(self, limit):
+        """Claim at most `limit` new tasks."""
+        tasks, superseded = self.scheduler.schedule(limit)
+        for task in tasks + superseded:
+            self.notify(task)
+        Metrics.inc('anylatex_tasks_total', len(superseded),
+                    status='superseded')
+        return tasks
+
+    def notify(self, task):
+        """Publish the task's status to waiting clients."""
+        try:
+            TaskEvents.publish(
+                task.task_id, task.status,
+                pdf_id=getattr(task, 'pdf_id', None),
+                superseded_by=getattr(task, 'superseded_by', None))
+        except Exception as e:
+            print('Fail to publish task', task.task_id, 'Error: ', e)
 
     def start(self):
+        DB.warmup()
+        ensure_indexes()
         for _ in range(self.compiler_number):
             compiler_name = 'texlive-' + str(_)
             try:
@@ -87,151 +162,443 @@ class TaskMonitor:
                         }
                     }
                 )
+            else:
+                self.kill_stale_compiles(container)
             finally:
                 self.compilers.append(container)
 
+        # kill cancelled compiles, and if event driven wake up on new
+        # tasks and finished compiles, scan the db anyway every
+        # `scan_interval` in case a notification is lost
+        TaskEventListener(self.on_task_event).start()
+        threading.Thread(
+            target=self.keep_leases, name='LeaseKeeper', daemon=True
+        ).start()
+        CompilerStats.remove_stale()
+        threading.Thread(
+            target=self.publish_stats, name='StatsPublisher', daemon=True
+        ).start()
+        Metrics.add_collector(self.collect_metrics)
+        if self.metrics_port:
+            try:
+                serve_metrics(self.metrics_host, self.metrics_port)
+            except OSError as e:
+                # e.g. taken by another monitor on this host
+                print('Fail to serve metrics on port', self.metrics_port,
+                      'Error: ', e)
+
         while True:
-            # scan tasks in db and assign new tasks
-            new_tasks = self.scan()
+            self.wakeup.wait(self.wait_time())
+            self.wakeup.clear()
+            # process finished tasks' results
+            while True:
+                try:
+                    container = self.finished_containers.get(block=False)
+                except queue.Empty:
+                    break
+                task = self.compiling_containers.pop(container)
+                self.process_result(task)
+
+            self.reclaim()
+            # claim new tasks in db and assign them to idle compilers
             idle_compilers = [
                 container for container in self.compilers
                 if container not in self.compiling_containers
             ]
-            for i, new_task in enumerate(new_tasks[:len(idle_compilers)]):
-                # assign a new task
-                self.assign_new_task(idle_compilers[i], new_task)
-            # print('assign %d new tasks, %d tasks remain'
-            #       % (assigned_num, len(new_tasks) - assigned_num))
-
-            # check if any tasks finished
-            finished_containers = []
-            for container, task in self.compiling_containers.items():
-                if os.path.exists(task.finish_file):
-                    self.process_result(task)
-                    finished_containers.append(container)
-            for finished_container in finished_containers:
-                self.compiling_containers.pop(finished_container)
-
-            time.sleep(self.db_scan_interval)
+            waiting_tasks, self.waiting_tasks = self.waiting_tasks, []
+            for task in waiting_tasks:
+                if not idle_compilers:
+                    self.waiting_tasks.append(task)
+                elif not task.is_compiling():
+                    print('Skips', 'waiting task:', task.task_id)
+                elif self.assign_new_task(idle_compilers[0], task):
+                    idle_compilers.pop(0)
+            while idle_compilers:
+                new_tasks = self.scan(len(idle_compilers))
+                if not new_tasks:
+                    break
+                for new_task in new_tasks:
+                    # assign a new task, cached results need no compiler
+                    if self.assign_new_task(idle_compilers[0], new_task):
+                        idle_compilers.pop(0)
+            # commit compiled tasks of this loop together
+            try:
+                self.commit_results()
+            except Exception as e:
+                print('Fail to commit results', 'Error: ', e)
+
+            # evict expired and least recently used cache entries
+            if time.time() - self.last_evict_time > self.cache_evict_interval:
+                self.last_evict_time = time.time()
+                print('Evicted cache entries:', self.cache.evict())
+                print('Compile cache:', self.cache.stats())
+                print('Evicted workspaces:', self.workspaces.evict())
+                print('Scheduler:', self.scheduler.stats())
+
+    def kill_stale_compiles(self, container):
+        """Kill compiles left in a reused container by a dead monitor,
+        their tasks are reclaimed when the leases expire."""
+        command = ('for pid in $(pgrep -f "/bin/bash .*/{script}"); do '
+                   'kill -KILL -- -$pid; done').format(
+                       script=self.script_name.replace('.', '\\.'))
+        try:
+            container.exec_run(['/bin/bash', '-c', command])
+        except Exception as e:
+            print('Container', container.name, 'error:', e)
+
+    def owned_tasks(self):
+        tasks = list(self.compiling_containers.values()) + \
+            list(self.compiled_tasks) + list(self.waiting_tasks)
+        return [task.task_id for task in tasks]
+
+    def reclaim(self):
+        """Compile again tasks whose owners stopped renewing leases."""
+        if time.time() - self.last_reclaim_time < self.lease_time / 2:
+            return
+        self.last_reclaim_time = time.time()
+        retried, failed = Task.reclaim_expired(self.max_attempts)
+        for task in retried + failed:
+            print('Reclaimed task', task.task_id, 'status:', task.status)
+            self.notify(task)
+        Metrics.inc('anylatex_tasks_total', len(retried), status='retried')
+        Metrics.inc('anylatex_tasks_total', len(failed), status='failed')
+
+    def keep_leases(self):
+        """Renew leases of owned tasks until the monitor exits."""
+        while True:
+            time.sleep(self.lease_time / 3)
+            try:
+                Task.renew_leases(
+                    self.owner, self.owned_tasks(), self.lease_time)
+            except Exception as e:
+                print('Fail to renew leases', 'Error: ', e)
+
+    def publish_stats(self, interval=1):
+        """Report this monitor's load every `interval` seconds until the
+        monitor exits."""
+        while True:
+            time.sleep(interval)
+            service_times = list(self.service_times)
+            try:
+                CompilerStats.publish(
+                    self.owner, self.compiler_number,
+                    len(self.owned_tasks()), self.scheduler.refresh_pending(),
+                    sum(service_times) / len(service_times)
+                    if service_times else None)
+            except Exception as e:
+                print('Fail to publish stats', 'Error: ', e)
+
+    def collect_metrics(self):
+        """Update gauges of containers before a scrape."""
+        busy = len(self.compiling_containers)
+        Metrics.set('anylatex_workers', busy, state='busy')
+        Metrics.set('anylatex_workers', len(self.compilers) - busy,
+                    state='idle')
+
+    def wait_time(self):
+        """Get seconds to wait for the next scan, debounced tasks are
+        claimed as soon as their window passes."""
+        timeout = self.scan_interval
+        if self.coalesce_window:
+            next_claim_time = Task.next_claim_time(self.coalesce_window)
+            if next_claim_time is not None:
+                timeout = min(timeout, max(next_claim_time - time.time(), 0))
+        return timeout
+
+    def on_task_event(self, event):
+        if event['status'] == 'new':
+            if self.event_driven:
+                self.wakeup.set()
+        elif event['status'] in ('cancelled', 'superseded'):
+            self.cancel(event['task_id'])
+
+    def cancel(self, task_id):
+        """Kill a deleted or superseded task's running compile.
+
+            The compile runs in its own process group whose id is written
+            to the workspace's pid file, killing the group ends the exec
+            and the container becomes idle.
+
+        """
+        for container, task in list(self.compiling_containers.items()):
+            if task.task_id != task_id:
+                continue
+            task.cancelled = True
+            pidfile = os.path.join(task.workspace, self.pid_name)
+            # the pid file may not be written yet
+            command = ('for i in $(seq 20); do [ -s {pidfile} ] && break; '
+                       'sleep 0.05; done; kill -KILL -- -$(cat {pidfile})'
+                       ).format(pidfile=pidfile)
+            try:
+                container.exec_run(['/bin/bash', '-c', command])
+                print('Cancelled task', task_id, 'in', container.name)
+            except Exception as e:
+                print('Fail to cancel task', task_id, 'Error: ', e)
+
+    def exec_in_container(self, container, task, command):
+        """Run a compile command, store its pdf and notify when it
+        finishes.
+
+            Pdfs are stored by these threads in parallel, the monitor
+            only commits results.
+
+        """
+        stage = dict(template=task.template)
+        try:
+            task.stamp('tex_started')
+            with Metrics.timer('anylatex_stage_seconds', stage='tex',
+                               **stage):
+                container.exec_run(command)
+            task.stamp('tex_finished')
+            if not getattr(task, 'cancelled', False):
+                with Metrics.timer('anylatex_stage_seconds', stage='store',
+                                   **stage):
+                    task.pdf_id = self.store_pdf(task)
+                if task.pdf_id:
+                    task.stamp('stored')
+        except Exception as e:
+            print('Container', container.name, 'error:', e)
+        finally:
+            self.finished_containers.put(container)
+            self.wakeup.set()
 
     def assign_new_task(self, container, task):
-        task.status = 'compiling'
-        task.update_to_db()
+        """Start compiling a task in the container.
+
+            Return False if the task is finished by a cached result or
+            waits for its workspace, the container stays idle.
+
+        """
         print('Start', 'processing task:', task.task_id)
-        # create temp directory
-        compile_tmp_dir = os.path.join(
-            self.compile_tmp_dir, task.user_id + task.document_id)
-        if not os.path.exists(compile_tmp_dir):
-            os.mkdir(compile_tmp_dir)
         filename = task.document_id + '.tex'
-        filepath = os.path.join(compile_tmp_dir, filename)
         pdfname = task.document_id + '.pdf'
-        pdfpath = os.path.join(compile_tmp_dir, pdfname)
-        task.pdfpath = pdfpath
+        fmt_filename = task.document_id + '-fmt.tex'
+        fmt_pdfname = task.document_id + '-fmt.pdf'
         # get template's arguments and write them into the structure document
         args = task.args
         part_args = task.part_args
         sub_dict = dict(documentclass=task.template, body=task.body)
-        # get structure document path
-        structure = self.template_configs[task.template]['structure']
-        # TODO: need to optimize
-        if args['references']:
-            biber_structure = structure.replace(
-                '.structure',
-                '-biber.structure'
-            )
-            structure_path = os.path.join(self.structure_dir, biber_structure)
-            if os.path.exists(structure_path):
-                structure = biber_structure
-        structure_path = os.path.join(self.structure_dir, structure)
-        with open(structure_path, 'r') as f:
-            structure_t = Template(f.read())
+        stage = dict(template=task.template)
+        render_start = time.time()
+        # get the parsed structure document, documents with references
+        # use the biber variant if exists
+        structure = self.templates.structure(
+            task.template, references=bool(args and args.get('references')))
         if args:
             for arg, value in args.items():
                 sub_dict[arg] = value
         if part_args:
             for arg, value in part_args.items():
                 sub_dict[arg] = value
-        latex = structure_t.substitute(sub_dict)
-        # fetch images in DB and save them to the compiling directory
+        latex = structure.substitute(sub_dict)
+        Metrics.observe('anylatex_stage_seconds', time.time() - render_start,
+                        stage='render', **stage)
+        # fetch images' metadata in DB
+        image_ids = {}
         for image_name in task.images:
             image_id, image_type = image_name.split('.')
-            image = Image(image_id=image_id, user_id=task.user_id)
-            try:
-                image.load_from_db()
-            except Exception as e:
-                print(e)
+            image_ids[image_name] = image_id
+        try:
+            with Metrics.timer('anylatex_stage_seconds', stage='images',
+                               **stage):
+                found_images = Image.find_for_user(
+                    task.user_id, image_ids.values())
+        except Exception as e:
+            print(e)
+            found_images = {}
+        images = {}
+        for image_name, image_id in image_ids.items():
+            if image_id not in found_images:
+                print('No image', image_id, 'of user', task.user_id)
                 continue
-            image_content = base64.b64decode(image.content.encode())
-            image_path = os.path.join(compile_tmp_dir, image_name)
-            with open(image_path, 'wb') as f:
-                f.write(image_content)
+            images[image_name] = found_images[image_id]
+        # skip compiling if the same inputs have been compiled
+        cls_path = self.templates.config(task.template).get('cls_path')
+        with Metrics.timer('anylatex_stage_seconds', stage='cache', **stage):
+            task.cache_key = self.cache.make_key(
+                task.user_id, latex,
+                asset_paths=[structure.path, cls_path],
+                image_hashes={
+                    image_name: image.content_hash()
+                    for image_name, image in images.items()
+                },
+                compile_cmd=self.compile_cmd
+            )
+            pdf_id = self.cache.get(task.cache_key)
+        Metrics.inc('anylatex_compile_cache_total',
+                    result='hit' if pdf_id else 'miss')
+        if pdf_id:
+            print('Reuses cached pdf for task:', task.task_id)
+            self.finish_task(task, pdf_id)
+            return False
+        # get the document's workspace, auxiliary files of the last
+        # compile are kept unless the template changes
+        inputs_start = time.time()
+        compile_tmp_dir = self.workspaces.acquire(
+            task.user_id, task.document_id,
+            fingerprint=task.template + ':' + structure.name,
+            owner=task.task_id
+        )
+        if not compile_tmp_dir:
+            # a superseded compile of the document is not killed yet
+            print('Task', task.task_id, 'waits for its workspace')
+            self.waiting_tasks.append(task)
+            return False
+        task.workspace = compile_tmp_dir
+        filepath = os.path.join(compile_tmp_dir, filename)
+        pdfpath = os.path.join(compile_tmp_dir, pdfname)
+        task.pdfpath = pdfpath
+        # save changed images to the compiling directory
+        for image_name, image in images.items():
+            if self.workspaces.is_current(
+                    compile_tmp_dir, image_name, image.content_hash()):
+                continue
+            with closing(image.open_content()) as f:
+                self.workspaces.write_stream(
+                    compile_tmp_dir, image_name, f, image.content_hash())
         # move cls to compile dir if exists
-        cls_path = self.template_configs[task.template].get('cls_path')
         if cls_path:
-            shutil.copy(
-                cls_path,
-                os.path.join(compile_tmp_dir, os.path.split(cls_path)[-1])
-            )
+            self.workspaces.copy_file(compile_tmp_dir, cls_path)
         # write tex file
-        with open(filepath, 'w') as f:
-            f.write(latex)
-        # start compiling
+        self.workspaces.write_file(compile_tmp_dir, filename, latex)
+        self.workspaces.remove_outputs(
+            compile_tmp_dir, [pdfname, fmt_pdfname, self.pid_name])
+        task.stamp('inputs')
         command = self.compile_cmd.format(
             filepath = filepath,
             outdir = compile_tmp_dir
         )
-        # create a file when finishing compiling the .tex file
-        finish_file = os.path.join(compile_tmp_dir, 'finished')
-        command += '; touch %s' % finish_file
-        command = '/bin/bash -c "%s"' % command
-        task.finish_file = finish_file
-        container.exec_run(
-            command,
-            detach=True
-        )
-        print('Container', container.name, 'assigned a new task:', command)
+        # start from the template's precompiled preamble if usable
+        fmt_latex = None
+        if self.formats:
+            fmt_name, static = self.formats.prepare(
+                task.template, structure.name, structure.text, cls_path,
+                runner=lambda cmd: container.exec_run(
+                    '/bin/bash -c "%s"' % cmd)
+            )
+            if fmt_name:
+                fmt_latex = self.formats.apply(fmt_name, static, latex)
+        if fmt_latex:
+            self.formats.link(fmt_name, compile_tmp_dir)
+            self.workspaces.write_file(
+                compile_tmp_dir, fmt_filename, fmt_latex)
+            command = self.formats.command(
+                self.compile_cmd,
+                os.path.join(compile_tmp_dir, fmt_filename),
+                filepath, pdfpath, compile_tmp_dir
+            )
+        # start compiling in a new process group, the exec blocks a
+        # watcher thread until the compile finishes
+        script = os.path.join(compile_tmp_dir, self.script_name)
+        with open(script, 'w') as f:
+            f.write(command + '\n')
+        Metrics.observe('anylatex_stage_seconds', time.time() - inputs_start,
+                        stage='inputs', **stage)
+        command = [
+            '/bin/bash', '-c',
+            'setsid /bin/bash {script} & echo $! > {pidfile}; wait $!'.format(
+                script=script,
+                pidfile=os.path.join(compile_tmp_dir, self.pid_name))
+        ]
         self.compiling_containers[container] = task
+        threading.Thread(
+            target=self.exec_in_container,
+            args=(container, task, command),
+            daemon=True
+        ).start()
+        print('Container', container.name, 'assigned a new task:', command)
+        return True
 
-    def process_result(self, task):
+    def finish_task(self, task, pdf_id):
+        """Queue the task to be committed with its compiled pdf."""
+        delattr(task, 'cache_key')
+        task.pdf_id = pdf_id
+        self.compiled_tasks.append(task)
+
+    def commit_results(self):
+        """Add compiled tasks' pdfs to users' lists in one bulk write and
+        mark the tasks finished."""
+        tasks, self.compiled_tasks = self.compiled_tasks, []
+        if not tasks:
+            return
+        commit_start = time.time()
         try:
-            os.remove(task.finish_file)
-            delattr(task, 'finish_file')
-            pdfpath = task.pdfpath
-            delattr(task, 'pdfpath')
-            if not os.path.exists(pdfpath):
-                raise Exception('No pdf generated')
-            # get pdf b64 string and put into db
-            with open(pdfpath, 'rb') as f:
-                pdf_content = f.read()
-            pdf_b64 = base64.b64encode(pdf_content).decode('utf-8')
-            compiled_time = str(int(time.time()))
-            pdf = PDF(data=pdf_b64, compiled_time=compiled_time)
-            pdf.create_in_db()
-            task.pdf_id = pdf.pdf_id
-            user = User(user_id=task.user_id)
-            user.load_from_db()
-            user.compiled_pdfs.append(pdf.pdf_id)
-            user.update_to_db()
-            # update task into task
+            User.add_compiled_pdfs(
+                [(task.user_id, task.pdf_id) for task in tasks],
+                self.max_compiled_pdfs)
+        except Exception as e:
+            # the tasks are finished anyway, their pdfs are stored
+            print('Fail to add compiled pdfs to users', 'Error: ', e)
+        for task in tasks:
             task.status = "finished"
-            task.update_to_db()
+            try:
+                self.save_status(task)
+            except Exception as e:
+                print('Fail to save task', task.task_id, 'Error: ', e)
+        Metrics.observe('anylatex_commit_seconds', time.time() - commit_start)
+        # tasks waiting for these documents can be claimed
+        self.wakeup.set()
+
+    def save_status(self, task):
+        """Save a compiled task's status and pdf, the task is left alone if
+        it is deleted, no longer compiling or its lease is lost."""
+        condition = {'status': 'compiling', 'owner': self.owner}
+        task.stamp('finished')
+        if task.update_to_db(condition=condition):
+            Metrics.inc('anylatex_tasks_total', status=task.status)
+            if task.status == 'finished' and 'claimed' in task.timeline:
+                self.service_times.append(
+                    task.timeline['finished'] - task.timeline['claimed'])
+            self.notify(task)
+        else:
+            print('Task', task.task_id, 'is no longer compiling')
+
+    def process_result(self, task):
+        if getattr(task, 'cancelled', False):
+            # the task is deleted or superseded, nothing to save, outputs
+            # of a killed compile may be broken
+            if self.workspaces.owns(task.workspace, task.task_id):
+                self.workspaces.clear(task.workspace)
+                self.workspaces.release(task.workspace, task.task_id)
+            print('Cancelled', 'processing task:', task.task_id)
+            Metrics.inc('anylatex_tasks_total', status='cancelled')
+            return
+        # keep the workspace for the next compile
+        self.workspaces.release(task.workspace, task.task_id)
+        delattr(task, 'workspace')
+        delattr(task, 'pdfpath')
+        pdf_id = getattr(task, 'pdf_id', None)
+        if pdf_id:
+            self.finish_task(task, pdf_id)
             print('Ends', 'processing result:', task.task_id)
-        except Exception as e:
-            # this task fails
-            print('Fail to processing task', task.task_id, 'Error: ', e)
-            task.status = 'failed'
-            task.update_to_db()
             return
+        # this task fails
+        print('Fail to processing task', task.task_id)
+        delattr(task, 'cache_key')
+        task.status = 'failed'
+        self.save_status(task)
+
+    def store_pdf(self, task):
+        """Stream a compiled pdf into the blob storage and cache it.
+
+            Return:
+                pdf's id, None if no pdf generated
+        """
+        if not os.path.exists(task.pdfpath):
+            print('No pdf generated for task', task.task_id)
+            return None
+        compiled_time = str(int(time.time()))
+        pdf = PDF(user_id=task.user_id, compiled_time=compiled_time)
+        with open(task.pdfpath, 'rb') as f:
+            pdf.save_content(f)
+        pdf.create_in_db()
+        self.cache.put(task.cache_key, pdf.pdf_id)
+        return pdf.pdf_id
 
 
 if __name__ == '__main__':
-    import json
-    config_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-    config_path = os.path.join(config_path, 'config.json')
-    with open(config_path, 'r') as f:
-        config = json.load(f)
+    from models.db import config, config_path
 
-    t = TaskMonitor(**config)
+    t = TaskMonitor(config_path=config_path, **config)
     t.start()
 
@@ -0,0 +1,190 @@
+# coding: utf-8
+
+import os
+import re
+import glob
+import time
+import shutil
+import hashlib
+from string import Template
+
+
+DEFAULT_FORMAT_CMD = ('cd {outdir} && xelatex -ini -interaction=batchmode '
+                      '-jobname={jobname} \\&xelatex mylatexformat.ltx '
+                      '{filepath}')
+
+# preamble lines that are safe to dump into a format
+STATIC_LINE = re.compile(r'^\s*(%.*|\\(documentclass|usepackage|RequirePackage)'
+                         r'(\[[^\]]*\])?\{[^{}]*\}(\[[^\]]*\])?\s*)?$')
+
+
+def split_preamble(structure):
+    """Get the static beginning of a structure document's preamble.
+
+        Only leading \\documentclass and \\usepackage lines are static,
+        anything using other template arguments is read at compile time.
+
+    """
+    lines = structure.splitlines(keepends=True)
+    static = []
+    for line in lines:
+        if not STATIC_LINE.match(line.rstrip('\n')):
+            break
+        placeholders = [
+            match.group('named') or match.group('braced')
+            for match in Template.pattern.finditer(line)
+            if match.group('named') or match.group('braced')
+        ]
+        if any(name != 'documentclass' for name in placeholders):
+            break
+        static.append(line)
+    static = ''.join(static)
+    if '\\documentclass' not in static:
+        return ''
+    return static
+
+
+class FormatCache:
+
+    """Cache of precompiled preamble formats.
+
+        A format is dumped with mylatexformat once per template and
+        structure version. Documents then start with `%&<format>` and
+        skip the dumped part of the preamble up to `\\endofdump`. Formats
+        that fail to build are remembered and those templates compile
+        without a format, the build is retried after `retry_interval`
+        seconds.
+
+    """
+
+    def __init__(self, format_dir, format_cmd=DEFAULT_FORMAT_CMD,
+                 retry_interval=3600):
+        self.format_dir = os.path.realpath(format_dir)
+        if not os.path.exists(self.format_dir):
+            os.makedirs(self.format_dir)
+        self.format_cmd = format_cmd
+        self.retry_interval = retry_interval
+
+    def _failed_recently(self, failed_path):
+        """Check a format's failure marker, remove it once it expires."""
+        try:
+            failed_time = os.path.getmtime(failed_path)
+        except OSError:
+            return False
+        if time.time() - failed_time < self.retry_interval:
+            return True
+        try:
+            os.remove(failed_path)
+        except OSError:
+            pass
+        return False
+
+    def _format_name(self, template, structure, static, cls_path):
+        h = hashlib.sha256()
+        h.update(structure.encode('utf-8'))
+        h.update(static.encode('utf-8'))
+        if cls_path and os.path.isfile(cls_path):
+            with open(cls_path, 'rb') as f:
+                h.update(f.read())
+        template = re.sub(r'[^A-Za-z0-9]', '', template)
+        structure = re.sub(r'[^A-Za-z0-9]', '', structure)
+        return 'fmt-' + template + '-' + structure + '-' + h.hexdigest()[:16]
+
+    def prepare(self, template, structure, structure_text, cls_path, runner):
+        """Get a usable format of this template, build it if necessary.
+
+            `runner` runs a shell command. Return (format name, rendered
+            static preamble), or (None, None) if no format can be used.
+
+        """
+        static = split_preamble(structure_text)
+        if not static:
+            return None, None
+        static = Template(static).substitute(documentclass=template)
+        name = self._format_name(template, structure, static, cls_path)
+        fmt_path = os.path.join(self.format_dir, name + '.fmt')
+        failed_path = os.path.join(self.format_dir, name + '.failed')
+        if self._failed_recently(failed_path):
+            return None, None
+        if not os.path.exists(fmt_path):
+            self.build(name, static, cls_path, runner)
+        if not os.path.exists(fmt_path):
+            open(failed_path, 'w').close()
+            print('Fail to build format', name, 'of template', template)
+            return None, None
+        return name, static
+
+    def build(self, name, static, cls_path, runner):
+        """Dump the static preamble into `<name>.fmt`."""
+        # build in a private directory, other compilers may build the
+        # same format at the same time
+        build_dir = os.path.join(
+            self.format_dir, '%s-%d' % (name, os.getpid()))
+        os.makedirs(build_dir, exist_ok=True)
+        try:
+            filepath = os.path.join(build_dir, name + '.tex')
+            with open(filepath, 'w') as f:
+                f.write(static + '\\endofdump\n')
+            if cls_path and os.path.isfile(cls_path):
+                shutil.copy(cls_path, build_dir)
+            command = self.format_cmd.format(
+                outdir=build_dir, jobname=name, filepath=filepath)
+            print('Building format:', command)
+            runner(command)
+            built_path = os.path.join(build_dir, name + '.fmt')
+            if os.path.exists(built_path):
+                os.replace(built_path,
+                           os.path.join(self.format_dir, name + '.fmt'))
+                self._remove_old_versions(name)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    def _remove_old_versions(self, name):
+        """Remove other versions of a format of the same template and
+        structure."""
+        prefix = name.rsplit('-', 1)[0]
+        for path in glob.glob(os.path.join(self.format_dir, prefix + '-*')):
+            if os.path.basename(path).startswith(name):
+                continue
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def link(self, name, workspace):
+        """Make the format visible to TeX runs in the workspace."""
+        for path in glob.glob(os.path.join(workspace, 'fmt-*.fmt')):
+            if os.path.basename(path) != name + '.fmt':
+                os.remove(path)
+        target = os.path.join(workspace, name + '.fmt')
+        if os.path.exists(target):
+            return
+        source = os.path.join(self.format_dir, name + '.fmt')
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy(source, target)
+
+    @staticmethod
+    def apply(name, static, latex):
+        """Make a rendered document start from the format."""
+        if not latex.startswith(static):
+            return None
+        rest = latex[len(static):]
+        return '%&' + name + '\n' + static + '\\endofdump\n' + rest
+
+    @staticmethod
+    def command(compile_cmd, fmt_filepath, filepath, pdfpath, outdir):
+        """Compile with the format, fall back to a normal compile if the
+        format yields no pdf.
+
+            `fmt_filepath` is the document applied with the format and
+            `filepath` is the same document without it.
+
+        """
+        fmt_pdfpath = os.path.splitext(fmt_filepath)[0] + '.pdf'
+        fmt_command = compile_cmd.format(filepath=fmt_filepath, outdir=outdir)
+        command = compile_cmd.format(filepath=filepath, outdir=outdir)
+        return ('({fmt_command}); if [ -f {fmt_pdfpath} ]; '
+                'then cp -f {fmt_pdfpath} {pdfpath}; '
+                'else {command}; fi').format(
+                    fmt_command=fmt_command, fmt_pdfpath=fmt_pdfpath,
+                    pdfpath=pdfpath, command=command)
@@ -0,0 +1,180 @@
+# coding: utf-8
+
+import time
+import collections
+
+from models.tasks import Task
+from models.metrics import Metrics
+
+
+DEFAULT_PRIORITY_WEIGHTS = {'interactive': 4, 'bulk': 1}
+
+
+def percentile(values, p):
+    """Get the p-th percentile of values by the nearest rank."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round(p / 100 * (len(values) - 1)))
+    return values[min(len(values) - 1, index)]
+
+
+class FairScheduler:
+
+    """Scheduler of new tasks in front of the compilers.
+
+        New tasks are grouped into flows by priority class and user.
+        Classes share free compilers by deficit round robin weighted by
+        `priority_weights`, so bulk tasks still progress under interactive
+        load, and users of a class take turns, so a user submitting many
+        documents only delays their own. A user has at most `user_limit`
+        compiling tasks.
+
+    """
+
+    def __init__(self, priority_weights=None, user_limit=2, window=0,
+                 policy='wait', owner=None, lease_time=60, stats_size=1000):
+        self.priority_weights = priority_weights or DEFAULT_PRIORITY_WEIGHTS
+        self.user_limit = user_limit
+        self.window = window
+        self.policy = policy
+        # claims are leased to this owner
+        self.owner = owner
+        self.lease_time = lease_time
+        self.deficits = {priority: 0 for priority in self.priority_weights}
+        # users of every class in turn order
+        self.turns = {
+            priority: collections.OrderedDict()
+            for priority in self.priority_weights
+        }
+        # recent queue waits and claimed numbers of every class
+        self.waits = {
+            priority: collections.deque(maxlen=stats_size)
+            for priority in self.priority_weights
+        }
+        self.claimed = {priority: 0 for priority in self.priority_weights}
+        # claimable new tasks at the last scan
+        self.pending = 0
+        self.pending_time = 0
+
+    def _priority(self, priority):
+        if priority in self.priority_weights:
+            return priority
+        return next(iter(self.priority_weights))
+
+    def _next_user(self, priority, users):
+        """Get the next user of a class to take a turn."""
+        turns = self.turns[priority]
+        for user_id in users:
+            if user_id not in turns:
+                turns[user_id] = None
+        while True:
+            user_id, _ = turns.popitem(last=False)
+            # users without tasks lose their turn
+            if user_id in users:
+                turns[user_id] = None
+                return user_id
+
+    def pick(self, heads, running, slots):
+        """Pick at most `slots` of the flows' oldest tasks.
+
+            `heads` are from `Task.pending_heads` and `running` is the
+            numbers of compiling tasks by user.
+
+            Return:
+                picked heads in the order to claim
+        """
+        counts = dict(running)
+        flows = {priority: {} for priority in self.priority_weights}
+        for head in heads:
+            if counts.get(head['user_id'], 0) >= self.user_limit:
+                continue
+            flows[self._priority(head['priority'])][head['user_id']] = head
+        # idle classes do not save up turns
+        for priority, users in flows.items():
+            if not users:
+                self.deficits[priority] = 0
+        picked = []
+        while len(picked) < slots:
+            active = [priority for priority in flows if flows[priority]]
+            if not active:
+                break
+            while all(self.deficits[priority] < 1 for priority in active):
+                for priority in active:
+                    self.deficits[priority] += \
+                        self.priority_weights[priority]
+            priority = max(active, key=lambda p: self.deficits[p])
+            self.deficits[priority] -= 1
+            user_id = self._next_user(priority, flows[priority])
+            picked.append(flows[priority].pop(user_id))
+            counts[user_id] = counts.get(user_id, 0) + 1
+            if counts[user_id] >= self.user_limit:
+                for users in flows.values():
+                    users.pop(user_id, None)
+        return picked
+
+    def set_pending(self, heads):
+        self.pending = sum(head['count'] for head in heads)
+        self.pending_time = time.time()
+        Metrics.set('anylatex_pending_tasks', self.pending)
+
+    def refresh_pending(self, interval=1):
+        """Count pending tasks if not counted in `interval` seconds, keeps
+        the number fresh while compilers are full."""
+        if time.time() - self.pending_time >= interval:
+            self.set_pending(Task.pending_heads(self.window))
+        return self.pending
+
+    def schedule(self, limit):
+        """Claim at most `limit` new tasks in fair order.
+
+            Return:
+                (claimed tasks, superseded tasks)
+        """
+        tasks = []
+        superseded = []
+        waiting = []
+        if limit <= 0:
+            self.refresh_pending()
+            return tasks, superseded
+        running = Task.running_counts()
+        while len(tasks) < limit:
+            heads = Task.pending_heads(self.window, waiting)
+            if not waiting and not tasks:
+                self.set_pending(heads)
+            picks = self.pick(heads, running, limit - len(tasks))
+            if not picks:
+                break
+            for head in picks:
+                task, superseded_tasks = Task.claim_document(
+                    head['user_id'], head['document_id'], policy=self.policy,
+                    owner=self.owner, lease_time=self.lease_time)
+                superseded.extend(superseded_tasks)
+                if not task:
+                    # the document is still compiling
+                    waiting.append({
+                        'user_id': head['user_id'],
+                        'document_id': head['document_id']
+                    })
+                    continue
+                running[task.user_id] = running.get(task.user_id, 0) + 1
+                priority = self._priority(task.priority)
+                self.claimed[priority] += 1
+                wait = time.time() - task.submitted_time
+                self.waits[priority].append(wait)
+                Metrics.observe(
+                    'anylatex_queue_wait_seconds', wait, priority=priority)
+                tasks.append(task)
+        return tasks, superseded
+
+    def stats(self):
+        """Get claimed numbers and queue waits in seconds by class."""
+        return {
+            priority: {
+                'claimed': self.claimed[priority],
+                'wait_p50': percentile(self.waits[priority], 50),
+                'wait_p95': percentile(self.waits[priority], 95),
+                'wait_max': max(self.waits[priority], default=0.0)
+            }
+            for priority in self.priority_weights
+        }
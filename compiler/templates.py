@@ -0,0 +1,155 @@
+# coding: utf-8
+
+import os
+import json
+import time
+import hashlib
+from string import Template
+
+
+class Structure:
+
+    """A parsed structure document."""
+
+    def __init__(self, name, path, text):
+        self.name = name
+        self.path = path
+        self.text = text
+        self.template = Template(text)
+        self.hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def substitute(self, sub_dict):
+        return self.template.substitute(sub_dict)
+
+
+class TemplateRegistry:
+
+    """Registry of templates' configs and structure documents.
+
+        Configs and structures are read once and kept parsed in memory.
+        Files are checked at most every `check_interval` seconds and only
+        reloaded when their mtime or size changes and the content hash
+        differs.
+
+    """
+
+    def __init__(self, structure_dir, config_path=None, templates=None,
+                 check_interval=1):
+        self.structure_dir = structure_dir
+        self.config_path = config_path
+        self.check_interval = check_interval
+        # file path: (checked time, (mtime, size), content hash)
+        self._stats = {}
+        self._structures = {}
+        self._config_hash = None
+        self._set_templates(templates or {})
+
+    def _set_templates(self, templates):
+        body = json.dumps(templates, sort_keys=True).encode('utf-8')
+        self._templates = (
+            templates, body, hashlib.sha1(body).hexdigest())
+
+    def _changed(self, path):
+        """Check if a file changed since its last load.
+
+            A changed file is recorded as loaded by `_loaded` once its
+            content is parsed, a file read while being written is read
+            again at the next check.
+
+            Return:
+                (changed, file content or None, state to record)
+        """
+        now = time.time()
+        checked_time, stat, content_hash = self._stats.get(
+            path, (0, None, None))
+        if now - checked_time < self.check_interval:
+            return False, None, None
+        try:
+            st = os.stat(path)
+            new_stat = (st.st_mtime, st.st_size)
+        except OSError:
+            new_stat = None
+        if new_stat == stat:
+            self._stats[path] = (now, stat, content_hash)
+            return False, None, None
+        content = None
+        new_hash = None
+        if new_stat:
+            with open(path, 'rb') as f:
+                content = f.read()
+            new_hash = hashlib.sha256(content).hexdigest()
+        state = (now, new_stat, new_hash)
+        if new_hash == content_hash:
+            self._stats[path] = state
+            return False, None, None
+        return True, content, state
+
+    def _loaded(self, path, state):
+        self._stats[path] = state
+
+    def _check_config(self):
+        if not self.config_path:
+            return
+        changed, content, state = self._changed(self.config_path)
+        if not changed:
+            return
+        if content:
+            try:
+                config = json.loads(content.decode('utf-8'))
+            except ValueError as e:
+                # kept unrecorded to be read again
+                print('Fail to load templates from', self.config_path,
+                      'Error: ', e)
+                return
+            self._set_templates(config.get('templates', {}))
+            print('Loaded templates from', self.config_path)
+        self._loaded(self.config_path, state)
+
+    def templates(self):
+        self._check_config()
+        return self._templates[0]
+
+    def serialized(self):
+        """Get serialized templates and the body's etag."""
+        self._check_config()
+        return self._templates[1], self._templates[2]
+
+    def config(self, template):
+        """Get a template's config, following aliases like `default`."""
+        templates = self.templates()
+        template_config = templates.get(template)
+        while isinstance(template_config, str):
+            template_config = templates.get(template_config)
+        if template_config is None:
+            raise KeyError('unknown template: %s' % template)
+        return template_config
+
+    def _load_structure(self, name):
+        path = os.path.join(self.structure_dir, name)
+        changed, content, state = self._changed(path)
+        if changed:
+            if content is None:
+                self._structures.pop(path, None)
+            else:
+                self._structures[path] = Structure(
+                    name, path, content.decode('utf-8'))
+            self._loaded(path, state)
+        return self._structures.get(path)
+
+    def structure(self, template, references=False):
+        """Get the parsed structure document of a template.
+
+            Documents with references use the `-biber` variant of the
+            structure if exists.
+
+        """
+        name = self.config(template)['structure']
+        if references:
+            biber_name = name.replace('.structure', '-biber.structure')
+            structure = self._load_structure(biber_name)
+            if structure:
+                return structure
+        structure = self._load_structure(name)
+        if not structure:
+            raise KeyError('no structure document: %s' % name)
+        return structure
@@ -0,0 +1,286 @@
+# coding: utf-8
+
+import os
+import json
+import time
+import shutil
+import hashlib
+
+
+class WorkspaceManager:
+
+    """Manager of persistent per-document compiling directories.
+
+        A document is compiled in the same directory every time, so
+        latexmk's auxiliary files (.aux, .bbl, .toc, ...) are kept between
+        compiles and reruns need fewer passes. Inputs are only rewritten
+        when their content changes to keep their mtimes stable. Least
+        recently used workspaces are removed when the total size exceeds
+        `max_bytes`.
+
+        A workspace is locked by the task compiling in it, the id of the
+        task is written in the lock file. A newer task of the document
+        waits until a superseded compile is killed and released, and a
+        released or cleared workspace is only touched by its owner.
+
+    """
+
+    stamp_name = '.last_used'
+    lock_name = '.in_use'
+    manifest_name = '.inputs.json'
+    fingerprint_name = '.fingerprint'
+
+    def __init__(self, root, max_bytes=5*1024**3, lock_timeout=600,
+                 poll_interval=0.05):
+        # converting to real path
+        self.root = os.path.realpath(root)
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self.max_bytes = max_bytes
+        # locks older than this are left by dead compilers
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+
+    def path(self, user_id, document_id):
+        """Get a document's workspace, named by a hash of its ids so ids
+        from clients never point outside `root`."""
+        name = hashlib.sha256(
+            json.dumps([user_id, document_id]).encode('utf-8')).hexdigest()
+        return os.path.join(self.root, name)
+
+    def _check_workspace(self, path):
+        """Raise ValueError unless `path` is a workspace in `root`."""
+        if os.path.dirname(os.path.realpath(path)) != self.root:
+            raise ValueError('workspace outside %s: %s' % (self.root, path))
+
+    def _file_path(self, path, name):
+        """Get the path of a file in a workspace, raise ValueError if the
+        name points outside it."""
+        file_path = os.path.join(path, name)
+        if not os.path.realpath(file_path).startswith(
+                os.path.realpath(path) + os.sep):
+            raise ValueError('file outside workspace %s: %s' % (path, name))
+        return file_path
+
+    def acquire(self, user_id, document_id, fingerprint='', owner='',
+                wait=0):
+        """Get the workspace of a document and lock it for `owner`.
+
+            Auxiliary files are only valid for the same template, the
+            workspace is cleared when `fingerprint` changes.
+
+            Return:
+                workspace's path, None if another owner still holds it
+                after `wait` seconds
+        """
+        path = self.path(user_id, document_id)
+        os.makedirs(path, exist_ok=True)
+        deadline = time.time() + wait
+        while not self.lock(path, owner):
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+        fingerprint_path = os.path.join(path, self.fingerprint_name)
+        old_fingerprint = None
+        if os.path.exists(fingerprint_path):
+            with open(fingerprint_path, 'r') as f:
+                old_fingerprint = f.read()
+        if old_fingerprint != fingerprint:
+            self.clear(path)
+            with open(fingerprint_path, 'w') as f:
+                f.write(fingerprint)
+        open(os.path.join(path, self.stamp_name), 'w').close()
+        return path
+
+    def lock_owner(self, path):
+        try:
+            with open(os.path.join(path, self.lock_name), 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def owns(self, path, owner):
+        return self.lock_owner(path) == owner
+
+    def lock(self, path, owner):
+        """Mark the workspace in use by `owner`.
+
+            Return:
+                False if it is in use by another owner
+        """
+        lock_path = os.path.join(path, self.lock_name)
+        for _ in range(2):
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if self.owns(path, owner):
+                    return True
+                if self._in_use(path):
+                    return False
+                # left by a dead compiler
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(owner)
+            return True
+        return False
+
+    def release(self, path, owner):
+        """Mark the workspace not in use if `owner` still holds it.
+
+            Return:
+                True if released
+        """
+        if not self.owns(path, owner):
+            return False
+        try:
+            os.remove(os.path.join(path, self.lock_name))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def clear(self, path):
+        """Remove everything but the lock of a workspace."""
+        self._check_workspace(path)
+        for name in os.listdir(path):
+            if name == self.lock_name:
+                continue
+            file_path = os.path.join(path, name)
+            if os.path.isdir(file_path):
+                shutil.rmtree(file_path, ignore_errors=True)
+            else:
+                os.remove(file_path)
+
+    def remove(self, path):
+        self._check_workspace(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def remove_outputs(self, path, names):
+        """Remove outputs of the last compile, a failed compile must not
+        return a stale pdf."""
+        for name in names:
+            try:
+                os.remove(self._file_path(path, name))
+            except FileNotFoundError:
+                pass
+
+    def _load_manifest(self, path):
+        manifest_path = os.path.join(path, self.manifest_name)
+        if not os.path.exists(manifest_path):
+            return {}
+        try:
+            with open(manifest_path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def _save_manifest(self, path, manifest):
+        manifest_path = os.path.join(path, self.manifest_name)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def is_current(self, path, name, content_hash):
+        """Check if an input file exists with this content hash."""
+        if not os.path.exists(self._file_path(path, name)):
+            return False
+        return self._load_manifest(path).get(name) == content_hash
+
+    def write_file(self, path, name, content):
+        """Write an input file if its content changed.
+
+            Return True if the file is written.
+
+        """
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        content_hash = hashlib.sha256(content).hexdigest()
+        if self.is_current(path, name, content_hash):
+            return False
+        file_path = self._file_path(path, name)
+        with open(file_path + '.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(file_path + '.tmp', file_path)
+        manifest = self._load_manifest(path)
+        manifest[name] = content_hash
+        self._save_manifest(path, manifest)
+        return True
+
+    def write_stream(self, path, name, fileobj, content_hash,
+                     chunk_size=256*1024):
+        """Write an input file from a file object if `content_hash`
+        changed.
+
+            Return True if the file is written.
+
+        """
+        if self.is_current(path, name, content_hash):
+            return False
+        file_path = self._file_path(path, name)
+        with open(file_path + '.tmp', 'wb') as f:
+            for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+                f.write(chunk)
+        os.replace(file_path + '.tmp', file_path)
+        manifest = self._load_manifest(path)
+        manifest[name] = content_hash
+        self._save_manifest(path, manifest)
+        return True
+
+    def copy_file(self, path, src_path):
+        """Copy a file into the workspace if its content changed."""
+        with open(src_path, 'rb') as f:
+            content = f.read()
+        return self.write_file(path, os.path.split(src_path)[-1], content)
+
+    def _size(self, path):
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        return size
+
+    def _last_used(self, path):
+        try:
+            return os.path.getmtime(os.path.join(path, self.stamp_name))
+        except OSError:
+            return 0
+
+    def _in_use(self, path):
+        try:
+            lock_time = os.path.getmtime(os.path.join(path, self.lock_name))
+        except OSError:
+            return False
+        return time.time() - lock_time < self.lock_timeout
+
+    def evict(self):
+        """Remove least recently used workspaces beyond `max_bytes`.
+
+            Return number of removed workspaces.
+
+        """
+        workspaces = []
+        total_size = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if (not os.path.isdir(path) or os.path.islink(path)
+                    or name.startswith('.')):
+                continue
+            size = self._size(path)
+            total_size += size
+            workspaces.append((self._last_used(path), size, path))
+        evicted = 0
+        for last_used, size, path in sorted(workspaces):
+            if total_size <= self.max_bytes:
+                break
+            if self._in_use(path):
+                continue
+            self.remove(path)
+            total_size -= size
+            evicted += 1
+        return evicted
@@ -0,0 +1,181 @@
+# coding: utf-8
+
+import math
+import time
+import datetime
+
+from .db import DB, config
+from .tasks import Task
+
+
+class CompilerStats:
+
+    """Load reported by compiler monitors.
+
+        Every monitor keeps one document of its number of compilers,
+        claimed tasks, the pending tasks it saw and its recent compile
+        time, so waits are estimated without counting tasks.
+
+    {
+        "_id": "monitor's owner id",
+        "compilers": "number of compilers",
+        "busy": "claimed tasks not finished",
+        "pending": "claimable new tasks",
+        "service_time": "recent mean seconds from claim to finish",
+        "updated": "timestamp"
+    }
+
+    """
+
+    name = 'compiler_stats'
+    indexes = [
+        [('updated', 1)]
+    ]
+    default_service_time = 10
+
+    @classmethod
+    def publish(cls, owner, compilers, busy, pending, service_time=None):
+        DB.update_one(
+            cls.name, {'_id': owner},
+            {'compilers': compilers, 'busy': busy, 'pending': pending,
+             'service_time': service_time, 'updated': time.time()},
+            custom_id=True, upsert=True)
+
+    @classmethod
+    def remove_stale(cls, age=3600):
+        """Remove documents of monitors gone for `age` seconds."""
+        return DB.delete_many(
+            cls.name, {'updated': {'$lt': time.time() - age}})
+
+    @classmethod
+    def load(cls, ttl=30):
+        """Get stats of monitors reported in `ttl` seconds, combined.
+
+            Return:
+                dict of compilers, busy, pending and service_time, None if
+                no monitor reported
+        """
+        results = list(DB.find(
+            cls.name, {'updated': {'$gte': time.time() - ttl}}))
+        if not results:
+            return None
+        compilers = sum(result.get('compilers') or 0 for result in results)
+        timed = [result for result in results if result.get('service_time')]
+        service_time = cls.default_service_time
+        if timed:
+            service_time = sum(
+                result['service_time'] * result['compilers']
+                for result in timed
+            ) / max(1, sum(result['compilers'] for result in timed))
+        return {
+            'compilers': compilers,
+            'busy': sum(result.get('busy') or 0 for result in results),
+            # monitors see the same pending tasks
+            'pending': max(result.get('pending') or 0 for result in results),
+            'service_time': service_time
+        }
+
+
+class Admission:
+
+    """Admission control of new tasks.
+
+        A task is refused when the pending tasks or the estimated wait of
+        all compilers exceed `admission_max_pending` or
+        `admission_max_wait`, when its user has `user_max_pending` new or
+        compiling tasks, or has submitted `user_rate_limit` tasks in the
+        current `user_rate_window` seconds. Limits set to 0 are disabled.
+
+        Compilers' stats are cached by the process for a second, a user's
+        pending tasks are counted on an index up to the limit and rates
+        are counted in a document per user and window.
+
+    """
+
+    rate_name = 'submit_rates'
+    # windows are removed by mongo after they end
+    rate_indexes = [
+        {'keys': [('expires_at', 1)], 'expireAfterSeconds': 0}
+    ]
+    max_pending = config.get('admission_max_pending', 0)
+    max_wait = config.get('admission_max_wait', 0)
+    user_max_pending = config.get('user_max_pending', 0)
+    user_rate_limit = config.get('user_rate_limit', 0)
+    user_rate_window = config.get('user_rate_window', 60)
+    stats_ttl = config.get('compiler_stats_ttl', 30)
+    stats_cache_time = 1
+    # (loaded time, stats) of this process
+    _stats = (0, None)
+
+    @classmethod
+    def stats(cls):
+        loaded_time, stats = cls._stats
+        if time.time() - loaded_time >= cls.stats_cache_time:
+            stats = CompilerStats.load(cls.stats_ttl)
+            cls._stats = (time.time(), stats)
+        return stats
+
+    @classmethod
+    def estimated_wait(cls, stats):
+        """Estimate seconds until a new task starts compiling, None if no
+        compiler reported."""
+        if not stats or not stats['compilers']:
+            return None
+        ahead = stats['pending'] + stats['busy'] - stats['compilers'] + 1
+        if ahead <= 0:
+            return 0
+        return ahead * stats['service_time'] / stats['compilers']
+
+    @classmethod
+    def _count_rate(cls, user_id):
+        """Count a submission in the user's current window.
+
+            Return:
+                (submissions in the window, seconds until it ends)
+        """
+        now = time.time()
+        window_start = int(now // cls.user_rate_window) * \
+            cls.user_rate_window
+        window_end = window_start + cls.user_rate_window
+        result = DB.find_one_and_update(
+            cls.rate_name, {'_id': '%s:%d' % (user_id, window_start)},
+            {'$inc': {'count': 1},
+             '$setOnInsert': {
+                 'expires_at': datetime.datetime.utcfromtimestamp(window_end)
+             }},
+            upsert=True)
+        return result['count'], window_end - now
+
+    @classmethod
+    def check(cls, user_id):
+        """Check if a user may submit a task now.
+
+            Return:
+                (error or None if admitted, seconds to retry after,
+                 estimated start time or None)
+        """
+        stats = cls.stats()
+        wait = cls.estimated_wait(stats)
+        service_time = stats['service_time'] if stats \
+            else CompilerStats.default_service_time
+        if cls.max_pending and stats and stats['pending'] >= cls.max_pending:
+            retry_after = (stats['pending'] - cls.max_pending + 1) * \
+                service_time / max(1, stats['compilers'])
+            return 'Too many pending tasks', retry_after, None
+        if cls.max_wait and wait is not None and wait > cls.max_wait:
+            return 'Compilers are busy', wait - cls.max_wait, None
+        if cls.user_max_pending and Task.pending_count(
+                user_id, cls.user_max_pending) >= cls.user_max_pending:
+            return 'Too many pending tasks of the user', service_time, None
+        if cls.user_rate_limit:
+            count, window_left = cls._count_rate(user_id)
+            if count > cls.user_rate_limit:
+                return 'Too many tasks submitted', window_left, None
+        estimated_start_time = None
+        if wait is not None:
+            estimated_start_time = time.time() + wait
+        return None, 0, estimated_start_time
+
+    @classmethod
+    def retry_after_header(cls, retry_after):
+        return str(max(1, int(math.ceil(retry_after))))
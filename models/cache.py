@@ -0,0 +1,58 @@
+# coding: utf-8
+
+import time
+from .db import DB
+from .model import Model
+
+
+class CacheEntry(Model):
+
+    """Compile cache entry.
+
+    {
+        'key': 'hash of the compile inputs',
+        'pdf_id': 'compiled pdf's id',
+        'created_time': 'timestamp',
+        'last_used': 'timestamp'
+    }
+
+    """
+
+    name = 'compile_cache'
+    id_key = 'key'
+    custom_id = True
+    indexes = [
+        [('created_time', 1)],
+        [('last_used', 1)]
+    ]
+
+    def __init__(self, key=None, pdf_id=None,
+                 created_time=None, last_used=None):
+
+        """Init a cache entry."""
+
+        self.key = key
+        self.pdf_id = pdf_id
+        self.created_time = created_time
+        if not self.created_time:
+            self.created_time = time.time()
+        self.last_used = last_used
+        if not self.last_used:
+            self.last_used = self.created_time
+
+    @classmethod
+    def delete_expired(cls, expired_time):
+        """Delete entries created before `expired_time`."""
+        return DB.delete_many(
+            cls.name, {'created_time': {'$lt': expired_time}})
+
+    @classmethod
+    def delete_least_recently_used(cls, max_entries):
+        """Delete least recently used entries beyond `max_entries`."""
+        excess = DB.count(cls.name, {}) - max_entries
+        if excess <= 0:
+            return 0
+        results = DB.find(cls.name, {}, projection=['_id'],
+                          sort=[('last_used', 1)], limit=excess)
+        keys = [result['_id'] for result in results]
+        return DB.delete_many(cls.name, {'_id': {'$in': keys}})
@@ -3,21 +3,149 @@
 
 import os
 import json
+import time
+import atexit
 import bson
+import calendar
+import datetime
+import functools
+import threading
+import gridfs
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, CursorType, UpdateOne
+from pymongo.errors import CollectionInvalid, PyMongoError
 
+from .metrics import Metrics
+
+# config.json of the repository unless ANYLATEX_CONFIG is set
 config_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-config_path = os.path.join(config_path, 'config.json')
+config_path = os.environ.get(
+    'ANYLATEX_CONFIG', os.path.join(config_path, 'config.json'))
 with open(config_path, 'r') as f:
     config = json.load(f)
 
 
+def timed(method):
+    """Observe latency of a DB call by its collection and operation.
+
+        Calls returning lazy cursors are not timed, their queries run
+        when iterated.
+
+    """
+    @functools.wraps(method)
+    def wrapper(cls, collection_name, *args, **kwargs):
+        start = time.time()
+        try:
+            return method(cls, collection_name, *args, **kwargs)
+        except Exception:
+            Metrics.inc('anylatex_mongo_errors_total',
+                        collection=collection_name, operation=method.__name__)
+            raise
+        finally:
+            Metrics.observe('anylatex_mongo_seconds', time.time() - start,
+                            collection=collection_name,
+                            operation=method.__name__)
+    return wrapper
+
+
 class DB:
 
+    """Access to the database.
+
+        The client is created on first use by every process, so importing
+        models connects to nothing and forked processes (gunicorn workers
+        of a preloaded app, compilers) never use the parent's client.
+        Its pool, timeouts, read preference and write concern are read
+        from config and may be changed by `configure` before first use.
+
+    """
+
     mongo_uri = config['mongo_uri']
-    client = MongoClient(mongo_uri)
-    db = client[config['db']]
+    db_name = config['db']
+    # MongoClient option: config key
+    option_keys = {
+        'maxPoolSize': 'mongo_max_pool_size',
+        'minPoolSize': 'mongo_min_pool_size',
+        'maxIdleTimeMS': 'mongo_max_idle_time_ms',
+        'waitQueueTimeoutMS': 'mongo_wait_queue_timeout_ms',
+        'connectTimeoutMS': 'mongo_connect_timeout_ms',
+        'socketTimeoutMS': 'mongo_socket_timeout_ms',
+        'serverSelectionTimeoutMS': 'mongo_server_selection_timeout_ms',
+        'readPreference': 'mongo_read_preference',
+        'w': 'mongo_write_concern',
+    }
+    options = {
+        option: config[key] for option, key in option_keys.items()
+        if config.get(key) is not None
+    }
+    # (pid, client, db) of the process which created the client
+    _connection = None
+    _lock = threading.Lock()
+    _lock_pid = os.getpid()
+
+    @classmethod
+    def get_db(cls):
+        """Get the database of this process's client."""
+        connection = cls._connection
+        if connection is None or connection[0] != os.getpid():
+            connection = cls._connect()
+        return connection[2]
+
+    @classmethod
+    def get_client(cls):
+        connection = cls._connection
+        if connection is None or connection[0] != os.getpid():
+            connection = cls._connect()
+        return connection[1]
+
+    @classmethod
+    def _connect(cls):
+        pid = os.getpid()
+        if cls._lock_pid != pid:
+            # may have been held by a thread of the parent when forked
+            cls._lock = threading.Lock()
+            cls._lock_pid = pid
+        with cls._lock:
+            connection = cls._connection
+            if connection is None or connection[0] != pid:
+                # a parent's client is dropped without closing, its
+                # sockets are still used by the parent
+                client = MongoClient(cls.mongo_uri, connect=False,
+                                     **cls.options)
+                connection = (pid, client, client[cls.db_name])
+                cls._connection = connection
+            return connection
+
+    @classmethod
+    def configure(cls, **options):
+        """Set MongoClient options of this process, e.g. `maxPoolSize`.
+
+            A client already created by this process is closed, the next
+            call creates one with the new options.
+        """
+        cls.options = dict(cls.options, **options)
+        cls.close()
+
+    @classmethod
+    def warmup(cls):
+        """Connect now rather than on the first request.
+
+            Return:
+                True if the server answered
+        """
+        try:
+            cls.get_client().admin.command('ping')
+            return True
+        except PyMongoError as e:
+            print('Fail to connect to mongo', 'Error: ', e)
+            return False
+
+    @classmethod
+    def close(cls):
+        """Close this process's client, a later call creates a new one."""
+        connection, cls._connection = cls._connection, None
+        if connection is not None and connection[0] == os.getpid():
+            connection[1].close()
 
     @classmethod
     def convert_objectid(cls, query):
@@ -29,39 +157,222 @@ class DB:
                 raise e
 
     @classmethod
-    def find_all(cls, collection_name):
-        results = DB.db[collection_name].find()
-        return results
-
-    @classmethod
-    def find_one(cls, collection_name, query, custom_id=False):
+    @timed
+    def find_one(cls, collection_name, query, custom_id=False,
+                 projection=None):
         if not custom_id:
             DB.convert_objectid(query)
-        result = DB.db[collection_name].find_one(query)
+        result = DB.get_db()[collection_name].find_one(query, projection)
         if result:
             result.pop('_id')
         return result
 
     @classmethod
+    @timed
     def create_one(cls, collection_name, document):
-        object_id = DB.db[collection_name].insert_one(document).inserted_id
+        object_id = DB.get_db()[collection_name].\
+            insert_one(document).inserted_id
         # TODO: check if success
         # remove object id
         document.pop('_id')
         return str(object_id)
 
     @classmethod
-    def update_one(cls, collection_name, query, document, custom_id=False):
+    @timed
+    def update_one(cls, collection_name, query, document, custom_id=False,
+                   upsert=False):
+        """Set fields of a document.
+
+            Return:
+                True if a document matched the query
+        """
         if not custom_id:
             DB.convert_objectid(query)
-        result = DB.db[collection_name].\
-            update_one(query, {'$set': document}, upsert=True)
-        return result.modified_count == 1
+        result = DB.get_db()[collection_name].\
+            update_one(query, {'$set': document}, upsert=upsert)
+        return result.matched_count == 1 or result.upserted_id is not None
 
     @classmethod
+    @timed
+    def bulk_update(cls, collection_name, updates, custom_id=False):
+        """Apply (query, update) pairs in one unordered bulk write.
+
+            Return:
+                number of matched documents
+        """
+        if not updates:
+            return 0
+        operations = []
+        for query, update in updates:
+            if not custom_id:
+                DB.convert_objectid(query)
+            operations.append(UpdateOne(query, update))
+        result = DB.get_db()[collection_name].\
+            bulk_write(operations, ordered=False)
+        return result.matched_count
+
+    @classmethod
+    @timed
     def delete_one(cls, collection_name, query, custom_id=False):
         if not custom_id:
             DB.convert_objectid(query)
-        result = DB.db[collection_name].delete_one(query)
+        result = DB.get_db()[collection_name].delete_one(query)
         return result.deleted_count == 1
 
+    @classmethod
+    def find(cls, collection_name, query, projection=None,
+             sort=None, limit=0, batch_size=0):
+        cursor = DB.get_db()[collection_name].find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+
+    @classmethod
+    @timed
+    def aggregate(cls, collection_name, pipeline):
+        return DB.get_db()[collection_name].aggregate(pipeline)
+
+    @classmethod
+    @timed
+    def count(cls, collection_name, query, limit=0):
+        """Count documents matching the query, at most `limit` if set."""
+        if limit:
+            return DB.get_db()[collection_name].count_documents(
+                query, limit=limit)
+        return DB.get_db()[collection_name].count_documents(query)
+
+    @classmethod
+    @timed
+    def update_many(cls, collection_name, query, document):
+        result = DB.get_db()[collection_name].\
+            update_many(query, {'$set': document})
+        return result.modified_count
+
+    @classmethod
+    def object_ids(cls, ids):
+        """Convert id strings to ObjectIds."""
+        return [
+            object_id if isinstance(object_id, ObjectId)
+            else ObjectId(object_id)
+            for object_id in ids
+        ]
+
+    @classmethod
+    def id_before(cls, timestamp):
+        """Get the smallest ObjectId generated at `timestamp`, ids less
+        than it are generated before."""
+        return ObjectId.from_datetime(
+            datetime.datetime.utcfromtimestamp(timestamp))
+
+    @classmethod
+    def id_time(cls, object_id):
+        """Get the timestamp when an ObjectId was generated."""
+        return calendar.timegm(object_id.generation_time.utctimetuple())
+
+    @classmethod
+    @timed
+    def delete_many(cls, collection_name, query):
+        result = DB.get_db()[collection_name].delete_many(query)
+        return result.deleted_count
+
+    @classmethod
+    @timed
+    def find_one_and_update(cls, collection_name, query, update,
+                            projection=None, sort=None, upsert=False):
+        """Atomically update a document and return it after the update."""
+        return DB.get_db()[collection_name].find_one_and_update(
+            query, update, projection=projection, sort=sort, upsert=upsert,
+            return_document=ReturnDocument.AFTER)
+
+    @classmethod
+    @timed
+    def create_index(cls, collection_name, keys, **kwargs):
+        return DB.get_db()[collection_name].create_index(keys, **kwargs)
+
+    @classmethod
+    def index_spec(cls, index):
+        """Split an index declared as a list of keys, or a dict of `keys`
+        and index options.
+
+            Return:
+                (keys, options)
+        """
+        if isinstance(index, dict):
+            options = dict(index)
+            return options.pop('keys'), options
+        return index, {}
+
+    @classmethod
+    def index_information(cls, collection_name):
+        """Get existing indexes of a collection by name."""
+        return DB.get_db()[collection_name].index_information()
+
+    @classmethod
+    def drop_index(cls, collection_name, index_name):
+        DB.get_db()[collection_name].drop_index(index_name)
+
+    @classmethod
+    def explain(cls, collection_name, query, projection=None, sort=None,
+                limit=0):
+        """Get the query planner's output of a find."""
+        return DB.find(collection_name, query, projection=projection,
+                       sort=sort, limit=limit).explain()
+
+    @classmethod
+    def create_capped_collection(cls, collection_name, size):
+        """Create a capped collection if not exists."""
+        if collection_name in DB.get_db().list_collection_names():
+            return
+        try:
+            DB.get_db().create_collection(
+                collection_name, capped=True, size=size)
+        except CollectionInvalid:
+            # created by another process
+            pass
+
+    @classmethod
+    def tail(cls, collection_name, query, max_await_time_ms=1000):
+        """Get a tailable cursor of a capped collection."""
+        return DB.get_db()[collection_name].find(
+            query, cursor_type=CursorType.TAILABLE_AWAIT
+        ).max_await_time_ms(max_await_time_ms)
+
+    @classmethod
+    @timed
+    def upload_file(cls, bucket_name, filename, fileobj, metadata=None):
+        """Stream a file object into a GridFS bucket.
+
+            Return:
+                file's id string
+        """
+        bucket = gridfs.GridFSBucket(DB.get_db(), bucket_name=bucket_name)
+        file_id = bucket.upload_from_stream(
+            filename, fileobj, metadata=metadata)
+        return str(file_id)
+
+    @classmethod
+    @timed
+    def open_file(cls, bucket_name, file_id):
+        """Open a seekable file object of a file in a GridFS bucket."""
+        bucket = gridfs.GridFSBucket(DB.get_db(), bucket_name=bucket_name)
+        try:
+            return bucket.open_download_stream(ObjectId(file_id))
+        except gridfs.errors.NoFile:
+            return None
+
+    @classmethod
+    @timed
+    def delete_file(cls, bucket_name, file_id):
+        bucket = gridfs.GridFSBucket(DB.get_db(), bucket_name=bucket_name)
+        try:
+            bucket.delete(ObjectId(file_id))
+            return True
+        except gridfs.errors.NoFile:
+            return False
+
+
+atexit.register(DB.close)
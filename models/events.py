@@ -0,0 +1,137 @@
+# coding: utf-8
+
+import time
+import queue
+import threading
+from .db import DB
+
+
+class TaskEvents:
+
+    """Notifications of tasks' status changes.
+
+        Events are kept in a capped collection and read with tailable
+        cursors, which a standalone mongod supports (change streams need
+        a replica set).
+
+    {
+        'task_id': 'task id',
+        'status': 'task's new status',
+        'time': 'timestamp'
+    }
+
+    """
+
+    name = 'task_events'
+    size = 16 * 1024 * 1024
+    _ready = False
+
+    @classmethod
+    def ensure_collection(cls):
+        if cls._ready:
+            return
+        DB.create_capped_collection(cls.name, cls.size)
+        # tailable cursors die on an empty collection
+        if not DB.find_one(cls.name, {}, custom_id=True):
+            DB.create_one(cls.name, {'task_id': None, 'status': None,
+                                     'time': time.time()})
+        cls._ready = True
+
+    @classmethod
+    def publish(cls, task_id, status, **fields):
+        """Publish a task's status change."""
+        cls.ensure_collection()
+        event = dict(fields, task_id=task_id, status=status, time=time.time())
+        DB.create_one(cls.name, event)
+
+
+class TaskEventListener(threading.Thread):
+
+    """Thread calling `callback` with every new task event.
+
+        The listener is positioned at the newest event by `start` before
+        the thread runs, so no event published after `start` returns is
+        missed.
+
+    """
+
+    def __init__(self, callback, name='TaskEventListener'):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.callback = callback
+        self.last_id = None
+        self.located = False
+
+    def locate(self):
+        """Start from the newest event."""
+        TaskEvents.ensure_collection()
+        newest = list(DB.find(TaskEvents.name, {},
+                              sort=[('$natural', -1)], limit=1))
+        self.last_id = newest[0]['_id'] if newest else None
+        self.located = True
+
+    def start(self):
+        try:
+            self.locate()
+        except Exception as e:
+            # located by the thread once the db is back
+            print(self.name, 'error:', e)
+        threading.Thread.start(self)
+
+    def run(self):
+        while True:
+            try:
+                if not self.located:
+                    self.locate()
+                query = {'_id': {'$gt': self.last_id}} if self.last_id \
+                    else {}
+                cursor = DB.tail(TaskEvents.name, query)
+                while cursor.alive:
+                    for event in cursor:
+                        self.last_id = event.pop('_id')
+                        self.callback(event)
+            except Exception as e:
+                print(self.name, 'error:', e)
+                time.sleep(1)
+
+
+class TaskEventBroker:
+
+    """Dispatcher of task events to waiting subscribers.
+
+        One listener thread per process tails the events, so waiting
+        clients never query the db by themselves.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.listener = None
+
+    def subscribe(self, task_id):
+        """Get a queue receiving events of the task.
+
+            The listener is started and positioned before returning, the
+            task's status read after subscribing is never newer than the
+            events received.
+        """
+        with self.lock:
+            if self.listener is None:
+                self.listener = TaskEventListener(self.dispatch)
+                self.listener.start()
+            subscriber = queue.Queue()
+            self.subscribers.setdefault(task_id, []).append(subscriber)
+            return subscriber
+
+    def unsubscribe(self, task_id, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(task_id, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+            if not subscribers:
+                self.subscribers.pop(task_id, None)
+
+    def dispatch(self, event):
+        with self.lock:
+            for subscriber in self.subscribers.get(event['task_id'], []):
+                subscriber.put(event)
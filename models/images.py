@@ -1,20 +1,105 @@
 # coding: utf-8
 
+import io
 import time
+import base64
+import hashlib
+from .db import DB
 from .users import User
-from .model import Model, ModelError
+from .model import Model, ModelError, ModelNotExistError
+from .storage import get_storage
+
+
+class Base64Reader(io.RawIOBase):
+
+    """Seekable stream decoding a b64 string chunk by chunk.
+
+        The string is not copied, whitespace is skipped chunk by chunk.
+        Seeking backwards decodes again from the start.
+
+    """
+
+    def __init__(self, b64):
+        self.b64 = b64
+        # position in the string and in the decoded content
+        self.pos = 0
+        self.offset = 0
+        # decoded bytes not read yet
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _next_chars(self, size):
+        """Get the next b64 characters decoding into about `size` bytes."""
+        # every 4 b64 characters decode into 3 bytes
+        wanted = max(size // 3, 1) * 4
+        chars = ''
+        while len(chars) < wanted and self.pos < len(self.b64):
+            chunk = self.b64[self.pos:self.pos + wanted - len(chars)]
+            self.pos += len(chunk)
+            chars += ''.join(chunk.split())
+        return chars
+
+    def readinto(self, b):
+        if not self.pending:
+            self.pending = base64.b64decode(self._next_chars(len(b)))
+        size = min(len(b), len(self.pending))
+        b[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        self.offset += size
+        return size
+
+    def length(self):
+        """Get the decoded length without decoding."""
+        chars = len(self.b64) - sum(
+            self.b64.count(space) for space in ' \t\n\r\v\f')
+        padding = 0
+        i = len(self.b64) - 1
+        while i >= 0 and (self.b64[i] == '=' or self.b64[i].isspace()):
+            padding += self.b64[i] == '='
+            i -= 1
+        return chars // 4 * 3 - padding
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.offset
+        elif whence == io.SEEK_END:
+            offset += self.length()
+        if offset >= self.length():
+            self.pos, self.offset, self.pending = len(self.b64), offset, b''
+            return self.offset
+        if offset < self.offset:
+            self.pos, self.offset, self.pending = 0, 0, b''
+        while self.offset < offset:
+            if not self.read(min(offset - self.offset, 65536)):
+                break
+        return self.offset
 
 
 class Image(Model):
 
-    """PDF object.
+    """Image object.
+
+        Content is uploaded as a b64 string and stored in a blob storage
+        (see `models.storage`), images stored before have their content
+        in `content`.
 
     {
         'image_id': 'image id',
         'user_id': 'user id',
         'uploaded_time': 'timestamp',
-        'content': 'bytes',
-        'hash': 'hash string'
+        'content': 'b64 string',
+        'hash': 'sha256 of the content',
+        'length': 'content length',
+        'storage': 'blob storage name',
+        'file_id': 'blob key in the storage'
     }
 
     """
@@ -22,9 +107,18 @@ class Image(Model):
     name = 'images'
     id_key = 'image_id'
     custom_id = True
+    bucket = 'image_files'
+    indexes = [
+        [('user_id', 1), ('hash', 1)],
+        [('user_id', 1), ('_id', 1)]
+    ]
+    # fields without the legacy b64 content
+    metadata_fields = ['user_id', 'uploaded_time', 'hash', 'length',
+                       'storage', 'file_id']
 
     def __init__(self, image_id=None, user_id=None,
-                 content=None, uploaded_time=None):
+                 content=None, uploaded_time=None, hash=None,
+                 length=None, storage=None, file_id=None):
 
         """Init an Image object."""
         self.image_id = image_id
@@ -33,18 +127,117 @@ class Image(Model):
         if not self.uploaded_time:
             self.uploaded_time = str(int(time.time()))
         self.content = content
+        self.hash = hash
+        self.length = length
+        self.storage = storage
+        self.file_id = file_id
 
-    def load_from_db(self):
-        if not self.user_id:
+    def _storage(self):
+        return get_storage(self.storage or 'gridfs', self.__class__.bucket)
+
+    def content_hash(self):
+        """Get sha256 hex digest of the decoded content."""
+        if not self.hash and self.content:
+            h = hashlib.sha256()
+            reader = Base64Reader(self.content)
+            for chunk in iter(lambda: reader.read(65536), b''):
+                h.update(chunk)
+            self.hash = h.hexdigest()
+        return self.hash
+
+    def open_content(self):
+        """Open a seekable file object of the decoded content."""
+        if self.content:
+            return io.BufferedReader(Base64Reader(self.content))
+        fileobj = None
+        if self.file_id:
+            fileobj = self._storage().open(self.file_id)
+        if not fileobj:
+            info = "No content of image {} in db"
+            raise ModelError(info.format(self.image_id))
+        return fileobj
+
+    def internal_url(self):
+        """Get the url for a front server to serve the content, or None."""
+        if self.content or not self.file_id:
+            return None
+        return self._storage().internal_url(self.file_id)
+
+    @classmethod
+    def find_for_user(cls, user_id, image_ids):
+        """Load a user's images in one query.
+
+            Only images stored before hashing have their content loaded,
+            others are opened from the blob storage when needed.
+
+            Return:
+                dict of image id to image
+        """
+        if not user_id:
             raise ModelError('No user id provided')
-        user = User(user_id=self.user_id)
-        user.load_from_db()
-        return super().load_from_db()
+        if not User(user_id=user_id).exists_in_db():
+            info = "Load images failed: no user of id {}"
+            raise ModelNotExistError(info.format(user_id))
+        results = list(DB.find(
+            cls.name, {'_id': {'$in': list(image_ids)}, 'user_id': user_id},
+            projection=cls.metadata_fields))
+        images = {}
+        for result in results:
+            image_id = result.pop('_id')
+            images[image_id] = cls(image_id=image_id, **result)
+            images[image_id]._mark_saved(result.keys())
+        legacy_ids = [
+            image_id for image_id, image in images.items() if not image.hash]
+        if legacy_ids:
+            results = DB.find(
+                cls.name, {'_id': {'$in': legacy_ids}, 'user_id': user_id},
+                projection=['content'])
+            for result in results:
+                images[result['_id']].content = result.get('content')
+        return images
 
-    def create_in_db(self):
+    @classmethod
+    def find_stored(cls, user_id, hash):
+        """Find a blob of the user's images with the same content.
+
+            Return:
+                dict of storage, file_id and length, None if not found
+        """
+        results = list(DB.find(
+            cls.name,
+            {'user_id': user_id, 'hash': hash, 'file_id': {'$ne': None}},
+            projection=['storage', 'file_id', 'length'], limit=1))
+        if not results:
+            return None
+        results[0].pop('_id')
+        return results[0]
+
+    def _check_user(self):
         if not self.user_id:
             raise ModelError('No user id provided')
-        user = User(user_id=self.user_id)
-        user.load_from_db()
-        return super().create_in_db()
+        if not User(user_id=self.user_id).exists_in_db():
+            info = "No user of id {}"
+            raise ModelNotExistError(info.format(self.user_id))
 
+    def load_from_db(self, fields=None):
+        self._check_user()
+        return super().load_from_db(fields)
+
+    def create_in_db(self):
+        self._check_user()
+        # move the content into the blob storage, the user's images of
+        # the same content share a blob
+        if self.content:
+            stored = self.find_stored(self.user_id, self.content_hash())
+            if stored:
+                self.storage = stored.get('storage')
+                self.file_id = stored['file_id']
+                self.length = stored.get('length')
+            else:
+                storage = get_storage(bucket=self.__class__.bucket)
+                self.storage = storage.name
+                with self.open_content() as f:
+                    self.file_id, self.length = storage.save(
+                        f, metadata={'user_id': self.user_id})
+            self.content = None
+        return super().create_in_db()
@@ -0,0 +1,203 @@
+# coding: utf-8
+
+"""Index bootstrap of all collections.
+
+    python3 -m models.indexes [--check] [--drop-unknown] [--no-explain]
+                              [--foreground]
+
+    Creates the indexes declared by models (`indexes` of a model), then
+    explains the queries services run and reports the index each one
+    uses, or COLLSCAN if it scans the collection. With `--check` nothing
+    is changed and the exit status is 1 if an index is missing or a query
+    scans a collection. Compiler monitors create missing indexes when
+    they start, see `ensure_indexes`. Indexes are built in the background
+    so existing collections stay available, `--foreground` builds them
+    faster on an idle db.
+
+"""
+
+import sys
+import time
+import argparse
+
+from .db import DB
+from .tasks import Task
+from .pdfs import PDF
+from .images import Image
+from .users import User
+from .cache import CacheEntry
+from .admission import CompilerStats, Admission
+
+
+def declared_indexes():
+    """Get declared indexes by collection name."""
+    return {
+        Task.name: Task.indexes,
+        PDF.name: PDF.indexes,
+        Image.name: Image.indexes,
+        User.name: User.indexes,
+        CacheEntry.name: CacheEntry.indexes,
+        CompilerStats.name: CompilerStats.indexes,
+        Admission.rate_name: Admission.rate_indexes,
+    }
+
+
+def service_queries():
+    """Get queries run by the services.
+
+        Values are placeholders, plans do not depend on matching
+        documents.
+
+        Return:
+            list of (description, collection, query, sort)
+    """
+    user_id = '0' * 24
+    document = {'user_id': user_id, 'document_id': 'document'}
+    now = time.time()
+    return [
+        ('claimable new tasks', Task.name,
+         Task._pending_query(window=2), [('_id', 1)]),
+        ('claim a document', Task.name,
+         dict(document, status='new'), [('_id', -1)]),
+        ('compiling tasks of a document', Task.name,
+         dict(document, status='compiling'), None),
+        ('user\'s pending tasks', Task.name,
+         {'user_id': user_id, 'status': {'$in': ['new', 'compiling']}}, None),
+        ('compiling tasks', Task.name, {'status': 'compiling'}, None),
+        ('expired leases', Task.name,
+         {'status': 'compiling', '$or': [
+             {'lease_expires': {'$lt': now}}, {'lease_expires': None}]},
+         None),
+        ('next claim time', Task.name,
+         {'status': 'new', '_id': {'$gte': DB.id_before(now - 2)}},
+         [('_id', 1)]),
+        ('latency report', Task.name,
+         {'timeline.finished': {'$gte': now - 3600}, 'status': 'finished'},
+         [('timeline.finished', -1)]),
+        ('user\'s tasks', Task.name,
+         {'user_id': user_id, '_id': {'$lt': DB.id_before(now)}},
+         [('_id', -1)]),
+        ('user\'s pdfs', PDF.name,
+         {'user_id': user_id, '_id': {'$lt': DB.id_before(now)}},
+         [('_id', -1)]),
+        ('user\'s images', Image.name,
+         {'user_id': user_id, '_id': {'$lt': 'image'}}, [('_id', -1)]),
+        ('stored image of a user', Image.name,
+         {'user_id': user_id, 'hash': '0' * 64, 'file_id': {'$ne': None}},
+         None),
+        ('expired cache entries', CacheEntry.name,
+         {'created_time': {'$lt': now}}, None),
+        ('least recently used cache entries', CacheEntry.name,
+         {}, [('last_used', 1)]),
+        ('compilers\' stats', CompilerStats.name,
+         {'updated': {'$gte': now - 30}}, None),
+    ]
+
+
+def ensure_indexes(drop_unknown=False, dry_run=False, background=True):
+    """Create declared indexes missing in the db, without locking the db
+    while building if `background`.
+
+        Return:
+            list of (collection, index keys or name, action), action is
+            `created`, `missing` in a dry run, or `dropped`/`unknown` for
+            indexes not declared
+    """
+    changes = []
+    for collection_name, indexes in declared_indexes().items():
+        existing = DB.index_information(collection_name)
+        existing_keys = {
+            name: [tuple(key) for key in info['key']]
+            for name, info in existing.items()
+        }
+        declared_keys = []
+        for index in indexes:
+            keys, options = DB.index_spec(index)
+            declared_keys.append(keys)
+            if keys in existing_keys.values():
+                continue
+            if not dry_run:
+                DB.create_index(collection_name, keys,
+                                background=background, **options)
+            changes.append((collection_name, keys,
+                            'missing' if dry_run else 'created'))
+        for name, keys in existing_keys.items():
+            if name == '_id_' or keys in declared_keys:
+                continue
+            if drop_unknown and not dry_run:
+                DB.drop_index(collection_name, name)
+                changes.append((collection_name, name, 'dropped'))
+            else:
+                changes.append((collection_name, name, 'unknown'))
+    return changes
+
+
+def plan_stages(plan):
+    """Get (stage, index name) of a plan and its input stages."""
+    stages = [(plan.get('stage'), plan.get('indexName'))]
+    inputs = plan.get('inputStages') or []
+    if plan.get('inputStage'):
+        inputs = [plan['inputStage']] + inputs
+    for input_stage in inputs:
+        stages.extend(plan_stages(input_stage))
+    return stages
+
+
+def coverage_report():
+    """Explain service queries.
+
+        Return:
+            list of (description, collection, 'COLLSCAN' or the indexes
+            used)
+    """
+    report = []
+    for description, collection_name, query, sort in service_queries():
+        explained = DB.explain(collection_name, query, sort=sort)
+        plan = explained.get('queryPlanner', {}).get('winningPlan', {})
+        stages = plan_stages(plan)
+        if any(stage == 'COLLSCAN' for stage, _ in stages):
+            used = 'COLLSCAN'
+        elif any(stage == 'IDHACK' for stage, _ in stages):
+            used = '_id_'
+        elif any(stage == 'EOF' for stage, _ in stages):
+            # the collection does not exist yet
+            used = 'no collection'
+        else:
+            used = ', '.join(sorted(set(
+                name for _, name in stages if name))) or 'unknown'
+        report.append((description, collection_name, used))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Create indexes and report queries\' index use.')
+    parser.add_argument('--check', action='store_true',
+                        help='only report, fail on missing indexes or '
+                             'collection scans')
+    parser.add_argument('--drop-unknown', action='store_true',
+                        help='drop indexes not declared by models')
+    parser.add_argument('--no-explain', action='store_true',
+                        help='skip the coverage report')
+    parser.add_argument('--foreground', action='store_true',
+                        help='build indexes in the foreground, the db is '
+                             'locked while building')
+    args = parser.parse_args(argv)
+
+    failed = False
+    for collection_name, index, action in ensure_indexes(
+            drop_unknown=args.drop_unknown, dry_run=args.check,
+            background=not args.foreground):
+        print('%-8s %-15s %s' % (action, collection_name, index))
+        failed = failed or action == 'missing'
+    if not args.no_explain:
+        for description, collection_name, used in coverage_report():
+            status = 'COLLSCAN' if used == 'COLLSCAN' else 'covered'
+            print('%-8s %-15s %-35s %s' % (
+                status, collection_name, description, used))
+            failed = failed or used == 'COLLSCAN'
+    return 1 if failed and args.check else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
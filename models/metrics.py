@@ -0,0 +1,329 @@
+# coding: utf-8
+
+import os
+import copy
+import json
+import time
+import bisect
+import threading
+import contextlib
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120, 300)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metrics:
+
+    """Process wide counters, gauges and histograms.
+
+        Metrics are declared in `definitions` and rendered in the
+        Prometheus text format. Compiler processes buffer observations
+        (see `buffer_observations`) and send them with their results to
+        the monitor, which replays them. API workers dump their metrics
+        into a shared directory, a scrape of any worker merges them.
+        Dumps of exited workers are removed, and ignored if older than
+        `dump_max_age` seconds.
+
+    """
+
+    # name: (type, help)
+    definitions = {
+        'anylatex_http_requests_total': (
+            'counter', 'API requests by method, endpoint and status.'),
+        'anylatex_http_request_seconds': (
+            'histogram', 'API request latency by method and endpoint.'),
+        'anylatex_mongo_seconds': (
+            'histogram', 'Mongo call latency by collection and operation.'),
+        'anylatex_mongo_errors_total': (
+            'counter', 'Failed Mongo calls by collection and operation.'),
+        'anylatex_stage_seconds': (
+            'histogram', 'Compile pipeline stage latency by template.'),
+        'anylatex_compile_cache_total': (
+            'counter', 'Compile cache lookups by result.'),
+        'anylatex_queue_wait_seconds': (
+            'histogram', 'Seconds from submitting to claiming by priority.'),
+        'anylatex_commit_seconds': (
+            'histogram', 'Latency of committing a batch of compiled tasks.'),
+        'anylatex_tasks_total': (
+            'counter', 'Tasks by the status they reached.'),
+        'anylatex_pending_tasks': (
+            'gauge', 'Claimable new tasks at the last scan.'),
+        'anylatex_task_queue_depth': (
+            'gauge', 'Items in the compilers\' local queues.'),
+        'anylatex_workers': (
+            'gauge', 'Compilers by state, busy ones are compiling a task.'),
+    }
+    buckets = DEFAULT_BUCKETS
+    lock = threading.Lock()
+    # (name, labels): value, or [bucket counts, sum, count] of histograms
+    values = {}
+    # observations not applied yet, see `buffer_observations`
+    buffer = None
+    # functions called before rendering to update gauges
+    collectors = []
+    last_dump_time = 0
+    dump_max_age = 3600
+
+    @classmethod
+    def _key(cls, name, labels):
+        if name not in cls.definitions:
+            raise KeyError('undefined metric: %s' % name)
+        return name, tuple(sorted(
+            (label, str(value)) for label, value in labels.items()))
+
+    @classmethod
+    def _record(cls, operation, name, value, labels):
+        """Buffer an observation, return True if buffered."""
+        if cls.buffer is None:
+            return False
+        cls._key(name, labels)
+        cls.buffer.append((operation, name, value, labels))
+        return True
+
+    @classmethod
+    def inc(cls, name, value=1, **labels):
+        if cls._record('inc', name, value, labels):
+            return
+        key = cls._key(name, labels)
+        with cls.lock:
+            cls.values[key] = cls.values.get(key, 0) + value
+
+    @classmethod
+    def set(cls, name, value, **labels):
+        if cls._record('set', name, value, labels):
+            return
+        key = cls._key(name, labels)
+        with cls.lock:
+            cls.values[key] = value
+
+    @classmethod
+    def observe(cls, name, value, **labels):
+        if cls._record('observe', name, value, labels):
+            return
+        key = cls._key(name, labels)
+        with cls.lock:
+            histogram = cls.values.get(key)
+            if histogram is None:
+                histogram = [[0] * (len(cls.buckets) + 1), 0.0, 0]
+                cls.values[key] = histogram
+            histogram[0][bisect.bisect_left(cls.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @classmethod
+    @contextlib.contextmanager
+    def timer(cls, name, **labels):
+        """Observe seconds spent in a with block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            cls.observe(name, time.time() - start, **labels)
+
+    @classmethod
+    def buffer_observations(cls):
+        """Keep observations of this process to be sent with `drain`.
+
+            Called in a forked compiler process, the lock is replaced
+            since it may have been held by a thread of the parent.
+
+        """
+        cls.lock = threading.Lock()
+        cls.values = {}
+        cls.buffer = []
+
+    @classmethod
+    def drain(cls):
+        """Get and clear buffered observations."""
+        if cls.buffer is None:
+            return []
+        observations, cls.buffer = cls.buffer, []
+        return observations
+
+    @classmethod
+    def replay(cls, observations):
+        """Apply observations drained in another process."""
+        for operation, name, value, labels in observations or []:
+            getattr(cls, operation)(name, value, **labels)
+
+    @classmethod
+    def add_collector(cls, collector):
+        cls.collectors.append(collector)
+
+    @classmethod
+    def snapshot(cls):
+        with cls.lock:
+            return [
+                [name, [list(label) for label in labels],
+                 copy.deepcopy(value)]
+                for (name, labels), value in cls.values.items()
+            ]
+
+    @classmethod
+    def dump(cls, metrics_dir, min_interval=0):
+        """Write this process's metrics to `metrics_dir` for other
+        processes' scrapes."""
+        if not metrics_dir:
+            return
+        if time.time() - cls.last_dump_time < min_interval:
+            return
+        cls.last_dump_time = time.time()
+        os.makedirs(metrics_dir, exist_ok=True)
+        path = os.path.join(metrics_dir, '%d.json' % os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(cls.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def remove_dump(cls, metrics_dir):
+        """Remove this process's dump when it exits."""
+        if not metrics_dir:
+            return
+        try:
+            os.remove(os.path.join(metrics_dir, '%d.json' % os.getpid()))
+        except OSError:
+            pass
+
+    @classmethod
+    def _dump_alive(cls, path, pid):
+        """Check if a dump's process is running and the dump is recent,
+        dumps of exited processes are removed."""
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return False
+        except PermissionError:
+            # running as another user
+            pass
+        try:
+            return time.time() - os.path.getmtime(path) < cls.dump_max_age
+        except OSError:
+            return False
+
+    @classmethod
+    def _merge(cls, merged, snapshot):
+        for name, labels, value in snapshot:
+            if name not in cls.definitions:
+                continue
+            key = name, tuple(tuple(label) for label in labels)
+            old = merged.get(key)
+            if old is None:
+                merged[key] = value
+            elif isinstance(value, list):
+                merged[key] = [
+                    [a + b for a, b in zip(old[0], value[0])],
+                    old[1] + value[1], old[2] + value[2]
+                ]
+            else:
+                merged[key] = old + value
+
+    @classmethod
+    def collect(cls, metrics_dir=None):
+        """Get current metrics, summed with other processes' dumps in
+        `metrics_dir`."""
+        for collector in cls.collectors:
+            try:
+                collector()
+            except Exception as e:
+                print('Fail to collect metrics', 'Error: ', e)
+        merged = {}
+        own_dump = '%d.json' % os.getpid()
+        if metrics_dir and os.path.isdir(metrics_dir):
+            for filename in os.listdir(metrics_dir):
+                if filename == own_dump or not filename.endswith('.json'):
+                    continue
+                path = os.path.join(metrics_dir, filename)
+                try:
+                    pid = int(filename[:-len('.json')])
+                except ValueError:
+                    continue
+                if not cls._dump_alive(path, pid):
+                    continue
+                try:
+                    with open(path) as f:
+                        cls._merge(merged, json.load(f))
+                except (OSError, ValueError):
+                    continue
+        cls._merge(merged, cls.snapshot())
+        return merged
+
+    @classmethod
+    def _format_labels(cls, labels):
+        if not labels:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (label, value.replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+            for label, value in labels)
+
+    @classmethod
+    def render(cls, metrics_dir=None):
+        """Get metrics in the Prometheus text format."""
+        merged = cls.collect(metrics_dir)
+        lines = []
+        for name, (metric_type, help_text) in cls.definitions.items():
+            samples = sorted(
+                (labels, value) for (metric, labels), value in merged.items()
+                if metric == name)
+            if not samples:
+                continue
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in samples:
+                if metric_type != 'histogram':
+                    lines.append('%s%s %s' % (
+                        name, cls._format_labels(labels), value))
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                bounds = ['%g' % bound for bound in cls.buckets] + ['+Inf']
+                for bound, bucket_count in zip(bounds, counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket%s %d' % (
+                        name, cls._format_labels(labels + (('le', bound),)),
+                        cumulative))
+                lines.append('%s_sum%s %s' % (
+                    name, cls._format_labels(labels), total))
+                lines.append('%s_count%s %d' % (
+                    name, cls._format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = Metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(host, port):
+    """Serve `/metrics` of this process on a port in a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name='MetricsServer', daemon=True
+    ).start()
+    print('Serving metrics on', '%s:%d' % (host, port))
+    return server
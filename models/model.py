@@ -1,5 +1,7 @@
 # coding: utf-8
 
+import copy
+
 from .db import DB
 
 
@@ -22,9 +24,62 @@ class Model:
     """Base model.
 
         All model classes should have cls.name and cls.id_key.
+        cls.indexes lists indexes of the collection, as index keys or
+        dicts of `keys` and index options (see `DB.index_spec`).
+
+        Values loaded from or saved to db are remembered, so updates only
+        write fields that changed since then.
 
     """
 
+    indexes = []
+
+    def __setattr__(self, name, value):
+        # fields assigned after a load are written even if not loaded
+        if self.__dict__.get('_saved') is not None \
+                and not name.startswith('_'):
+            self.__dict__['_assigned'].add(name)
+        object.__setattr__(self, name, value)
+
+    def _mark_saved(self, fields=None):
+        """Remember db values of `fields`, all fields if not provided."""
+        document = self.to_dict()
+        if fields is not None:
+            document = {
+                field: document[field]
+                for field in fields if field in document
+            }
+        saved = self.__dict__.get('_saved') or {}
+        saved.update(copy.deepcopy(document))
+        assigned = self.__dict__.get('_assigned') or set()
+        self.__dict__['_assigned'] = assigned - set(document)
+        self.__dict__['_saved'] = saved
+
+    def changed_fields(self):
+        """Get fields changed since loaded or saved.
+
+            Return:
+                dict of changed fields, None if never loaded or saved
+        """
+        saved = self.__dict__.get('_saved')
+        if saved is None:
+            return None
+        id_key = self.__class__.id_key
+        return {
+            field: value
+            for field, value in self.to_dict().items()
+            if field != id_key and (
+                (field in saved and value != saved[field]) or
+                (field not in saved and field in self._assigned))
+        }
+
+    @classmethod
+    def ensure_indexes(cls):
+        """Create indexes of this model's collection if not exist."""
+        for index in cls.indexes:
+            keys, options = DB.index_spec(index)
+            DB.create_index(cls.name, keys, **options)
+
     def to_dict(self):
         """Get dict format of this object."""
         # generate object's document
@@ -38,27 +93,70 @@ class Model:
         }
         return document
 
-    def _find_one_in_db(self, object_id):
+    def _find_one_in_db(self, object_id, projection=None):
         cls_name = self.__class__.name
         custom_id = getattr(self.__class__, 'custom_id', False)
         try:
             raw_object = DB.find_one(
-                cls_name, {"_id": object_id}, custom_id=custom_id)
+                cls_name, {"_id": object_id}, custom_id=custom_id,
+                projection=projection)
             return raw_object
         except Exception as e:
             raise ModelError(str(e))
 
     @classmethod
     def find_all(cls):
-        collection_name = cls.name
-        raw_results = DB.find_all(collection_name)
-        results = []
-        # convert objectid to cls id
-        for result in raw_results:
-            result[cls.id_key] = str(result['_id'])
-            result.pop('_id')
-            results.append(result)
-        return results
+        return list(cls.iter_from_db())
+
+    @classmethod
+    def iter_from_db(cls, query=None, fields=None, sort=None, limit=0,
+                     batch_size=100):
+        """Iterate over documents matching `query`.
+
+            Documents are fetched `batch_size` at a time, only `fields`
+            are loaded if provided.
+
+            Return:
+                generator of documents' dicts with their ids
+        """
+        cursor = DB.find(cls.name, query or {}, projection=fields,
+                         sort=sort, limit=limit, batch_size=batch_size)
+        try:
+            for result in cursor:
+                # convert objectid to cls id
+                result[cls.id_key] = str(result.pop('_id'))
+                yield result
+        finally:
+            cursor.close()
+
+    @classmethod
+    def page_from_db(cls, query, fields=None, after=None, limit=20):
+        """Get a page of documents matching `query` in descending id
+        order.
+
+            The next page starts after the last id of this one, so a page
+            costs an index seek and `limit` documents however deep it is.
+
+            Return:
+                (list of documents' dicts, id to get the next page after,
+                 None on the last page)
+        """
+        query = dict(query)
+        if after:
+            if not getattr(cls, 'custom_id', False):
+                try:
+                    after = DB.object_ids([after])[0]
+                except Exception:
+                    raise ModelError('Invalid cursor: {}'.format(after))
+            query['_id'] = {'$lt': after}
+        results = list(cls.iter_from_db(
+            query, fields, sort=[('_id', -1)], limit=limit + 1,
+            batch_size=limit + 1))
+        next_id = None
+        if len(results) > limit:
+            results = results[:limit]
+            next_id = results[-1][cls.id_key]
+        return results, next_id
 
     def exists_in_db(self):
         """Check if this id in db."""
@@ -67,14 +165,14 @@ class Model:
         if not object_id:
             info = "Check if exists in db failed: no id in this {} instance."
             raise ModelError(info.format(cls.__name__))
-        raw_object = self._find_one_in_db(object_id)
-        if raw_object:
+        raw_object = self._find_one_in_db(object_id, projection=['_id'])
+        if raw_object is not None:
             return True
         else:
             return False
 
-    def load_from_db(self):
-        """Load from DB using id."""
+    def load_from_db(self, fields=None):
+        """Load from DB using id, only `fields` if provided."""
 
         cls = self.__class__
 
@@ -83,8 +181,8 @@ class Model:
         if not object_id:
             info = "Load from db failed: no id({}) in this {} instance."
             raise ModelError(info.format(cls.id_key, cls.__name__))
-        raw_object = self._find_one_in_db(object_id)
-        if not raw_object:
+        raw_object = self._find_one_in_db(object_id, projection=fields)
+        if raw_object is None:
             info = "Load from db failed: no {} document in db of id {}"
             raise ModelNotExistError(info.format(cls.__name__, object_id))
 
@@ -94,6 +192,7 @@ class Model:
                 setattr(self, cls.id_key, value)
             else:
                 setattr(self, key, value)
+        self._mark_saved(raw_object.keys())
 
     def create_in_db(self):
         """Create this document, id should be None.
@@ -127,10 +226,19 @@ class Model:
         object_id = DB.create_one(cls.name, document)
         setattr(self, cls.id_key, object_id)
         document[cls.id_key] = object_id
+        self._mark_saved()
         return document
 
-    def update_to_db(self):
-        """Update this document, should have an id."""
+    def update_to_db(self, condition=None):
+        """Update this document, should have an id.
+
+            Only changed fields are written if this object was loaded or
+            saved before. With `condition`, the document is only updated
+            if it also matches this query.
+
+            Return:
+                True if updated, False if `condition` is not matched
+        """
 
         cls = self.__class__
         custom_id = getattr(cls, 'custom_id', False)
@@ -140,18 +248,31 @@ class Model:
         if not object_id:
             info = "Update to db failed: no id({}) in this {} instance."
             raise ModelError(info.format(cls.id_key, cls.__name__))
-        raw_object = self._find_one_in_db(object_id)
-        if not raw_object:
-            info = "Update to db failed: no {} document with id({}) in db."
-            raise ModelNotExistError(info.format(cls.__name__, object_id))
 
         # generate object's document
-        document = self.to_dict()
-        document.pop(cls.id_key)
+        document = self.changed_fields()
+        if document is None:
+            document = self.to_dict()
+            document.pop(cls.id_key)
+        if not document:
+            return True
 
         # update
-        # TODO: check if success
-        DB.update_one(cls.name, {'_id': object_id}, document, custom_id=custom_id)
+        query = {'_id': object_id}
+        if condition:
+            query.update(condition)
+        try:
+            updated = DB.update_one(
+                cls.name, query, document, custom_id=custom_id)
+        except Exception as e:
+            raise ModelError(str(e))
+        if not updated:
+            if condition:
+                return False
+            info = "Update to db failed: no {} document with id({}) in db."
+            raise ModelNotExistError(info.format(cls.__name__, object_id))
+        self._mark_saved(document.keys())
+        return True
 
     def delete_in_db(self):
         """Delete this document, should have an id."""
@@ -164,16 +285,13 @@ class Model:
         if not object_id:
             info = "Delete in db failed: no id({}) in this {} instance."
             raise ModelError(info.format(cls.id_key, cls.__name__))
-        raw_object = self._find_one_in_db(object_id)
-        if not raw_object:
+        # delete
+        try:
+            deleted = DB.delete_one(
+                cls.name, {'_id': object_id}, custom_id=custom_id)
+        except Exception as e:
+            raise ModelError(str(e))
+        if not deleted:
             info = "Delete in db failed: no {} document with id({}) in db."
             raise ModelNotExistError(info.format(cls.__name__, object_id))
 
-        # generate object's document
-        document = self.to_dict()
-        document.pop(cls.id_key)
-
-        # delete
-        # TODO: check if success
-        DB.delete_one(cls.name, {'_id': object_id}, custom_id=custom_id)
-
@@ -1,15 +1,25 @@
 # coding: utf-8
 
-from .model import Model
+import io
+import base64
+from .model import Model, ModelError
+from .storage import get_storage
 
 
 class PDF(Model):
 
     """PDF object.
 
+        Content is stored in a blob storage (see `models.storage`), PDFs
+        stored before have their content in `data`.
+
     {
         'pdf_id': 'pdf id',
+        'user_id': 'id of the user who compiled it',
         'compiled_time': 'timestamp',
+        'length': 'content length',
+        'storage': 'blob storage name',
+        'file_id': 'blob key in the storage',
         'data': 'b64 string'
     }
 
@@ -17,12 +27,51 @@ class PDF(Model):
 
     name = 'pdfs'
     id_key = 'pdf_id'
+    bucket = 'pdf_files'
+    indexes = [
+        [('user_id', 1), ('_id', 1)]
+    ]
 
-    def __init__(self, pdf_id=None, data=None, compiled_time=None):
+    def __init__(self, pdf_id=None, data=None, compiled_time=None,
+                 user_id=None, length=None, storage=None, file_id=None):
 
         """Init a PDF object."""
 
         self.pdf_id = pdf_id
-        self.compiled_time = None
-        self.data = data
+        self.user_id = user_id
+        self.compiled_time = compiled_time
+        self.length = length
+        self.storage = storage
+        self.file_id = file_id
+        if data:
+            self.data = data
+
+    def _storage(self):
+        return get_storage(self.storage or 'gridfs', self.__class__.bucket)
+
+    def save_content(self, fileobj):
+        """Stream the content from a file object into the blob storage."""
+        storage = get_storage(bucket=self.__class__.bucket)
+        self.storage = storage.name
+        self.file_id, self.length = storage.save(
+            fileobj, metadata={'user_id': self.user_id})
+
+    def open_content(self):
+        """Open a seekable file object of the content."""
+        if getattr(self, 'data', None):
+            content = base64.b64decode(self.data)
+            self.length = len(content)
+            return io.BytesIO(content)
+        fileobj = None
+        if self.file_id:
+            fileobj = self._storage().open(self.file_id)
+        if not fileobj:
+            info = "No content of PDF {} in db"
+            raise ModelError(info.format(self.pdf_id))
+        return fileobj
 
+    def internal_url(self):
+        """Get the url for a front server to serve the content, or None."""
+        if getattr(self, 'data', None) or not self.file_id:
+            return None
+        return self._storage().internal_url(self.file_id)
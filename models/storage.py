@@ -0,0 +1,148 @@
+# coding: utf-8
+
+import os
+import uuid
+import hashlib
+from .db import DB, config
+
+
+class BlobStorage:
+
+    """Base storage of binary contents.
+
+        A blob is saved from a file object and addressed by the returned
+        key.
+
+    """
+
+    name = ''
+
+    def save(self, fileobj, metadata=None):
+        """Save content of a file object.
+
+            Return:
+                (key, length)
+        """
+        raise NotImplementedError
+
+    def open(self, key):
+        """Open a seekable file object of a blob, None if not exists."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def internal_url(self, key):
+        """Get the url for a front server to serve the blob, or None."""
+        return None
+
+
+class GridFSStorage(BlobStorage):
+
+    """Blobs stored in chunks in a GridFS bucket."""
+
+    name = 'gridfs'
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def save(self, fileobj, metadata=None):
+        key = DB.upload_file(self.bucket, 'blob', fileobj, metadata=metadata)
+        return key, fileobj.tell()
+
+    def open(self, key):
+        return DB.open_file(self.bucket, key)
+
+    def delete(self, key):
+        return DB.delete_file(self.bucket, key)
+
+
+class FileSystemStorage(BlobStorage):
+
+    """Content addressed blobs in a directory.
+
+        A blob's key is the sha256 of its content and it is stored as
+        `<root>/<key[:2]>/<key[2:4]>/<key>`, so the same content is only
+        stored once. With `x_accel_prefix`, a front nginx serves blobs
+        from the same directory by internal redirects.
+
+    """
+
+    name = 'filesystem'
+
+    def __init__(self, root, x_accel_prefix=None, chunk_size=256*1024):
+        self.root = os.path.realpath(root)
+        self.tmp_dir = os.path.join(self.root, '.tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.x_accel_prefix = x_accel_prefix
+        self.chunk_size = chunk_size
+
+    def _relative_path(self, key):
+        return os.path.join(key[:2], key[2:4], key)
+
+    def path(self, key):
+        return os.path.join(self.root, self._relative_path(key))
+
+    def save(self, fileobj, metadata=None):
+        h = hashlib.sha256()
+        length = 0
+        tmp_path = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in iter(lambda: fileobj.read(self.chunk_size), b''):
+                    h.update(chunk)
+                    f.write(chunk)
+                    length += len(chunk)
+            key = h.hexdigest()
+            path = self.path(key)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return key, length
+
+    def open(self, key):
+        try:
+            return open(self.path(key), 'rb')
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key):
+        # blobs are shared by identical contents, never removed by a model
+        return False
+
+    def internal_url(self, key):
+        if not self.x_accel_prefix:
+            return None
+        return self.x_accel_prefix.rstrip('/') + '/' + \
+            self._relative_path(key).replace(os.sep, '/')
+
+
+_storages = {}
+
+
+def get_storage(name=None, bucket='blobs'):
+    """Get a blob storage by name, default to config's `blob_storage`.
+
+        `bucket` is the GridFS bucket used by the gridfs storage.
+
+    """
+    if not name:
+        name = config.get('blob_storage', GridFSStorage.name)
+    storage_key = (name, bucket)
+    if storage_key not in _storages:
+        if name == GridFSStorage.name:
+            storage = GridFSStorage(bucket)
+        elif name == FileSystemStorage.name:
+            storage = FileSystemStorage(
+                config.get('blob_dir', 'blobs'),
+                config.get('x_accel_prefix'))
+        else:
+            raise ValueError('unknown blob storage: %s' % name)
+        _storages[storage_key] = storage
+    return _storages[storage_key]
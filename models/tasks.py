@@ -1,5 +1,8 @@
 # coding: utf-8
 
+import time
+
+from .db import DB
 from .model import Model
 
 
@@ -9,24 +12,67 @@ class Task(Model):
 
     {
         "task_id": "task id",
-        "status": "new" or "compiling" or "finished",
+        "status": "new" or "compiling" or "finished" or "failed"
+                  or "superseded",
         "user_id": "user id",
         "document_id": "document's id",
         "template": "template to use",
         "args": "arguments",
         "part_args": "arguments show in editor",
         "images": "list of image names"
-        "pdf_id": "compiled pdf's id"
+        "priority": "interactive" or "bulk",
+        "submitted_time": "timestamp",
+        "claimed_time": "timestamp when compiling starts",
+        "owner": "id of the monitor compiling it",
+        "lease_expires": "timestamp, retried if not renewed before",
+        "attempts": "number of claims",
+        "pdf_id": "compiled pdf's id",
+        "superseded_by": "id of the newer task compiling the document",
+        "timeline": {
+            "submitted": "timestamp",
+            "claimed": "timestamp",
+            "inputs": "timestamp when inputs are written",
+            "tex_started": "timestamp",
+            "tex_finished": "timestamp",
+            "stored": "timestamp when the pdf is stored",
+            "finished": "timestamp when the status is saved"
+        }
     }
 
     """
 
     name = "tasks"
     id_key = "task_id"
+    indexes = [
+        [('status', 1), ('_id', 1)],
+        [('user_id', 1), ('document_id', 1), ('status', 1), ('_id', 1)],
+        [('status', 1), ('lease_expires', 1)],
+        [('timeline.finished', 1)],
+        [('user_id', 1), ('status', 1)],
+        [('user_id', 1), ('_id', 1)]
+    ]
+
+    # fields needed to compile a task
+    compile_fields = ['status', 'user_id', 'document_id', 'template',
+                      'args', 'part_args', 'body', 'images', 'priority',
+                      'submitted_time', 'timeline']
+    priorities = ['interactive', 'bulk']
+    # (phase, start, end) of timeline entries
+    timeline_phases = [
+        ('queue', 'submitted', 'claimed'),
+        ('inputs', 'claimed', 'inputs'),
+        ('prepare', 'inputs', 'tex_started'),
+        ('tex', 'tex_started', 'tex_finished'),
+        ('store', 'tex_finished', 'stored'),
+        ('commit', 'stored', 'finished'),
+        ('total', 'submitted', 'finished')
+    ]
+    report_percentiles = [50, 95, 99]
 
     def __init__(self, task_id=None, user_id=None, document_id=None,
                  status="new", template="", args={},
-                 part_args={}, body="", images=[], **other):
+                 part_args={}, body="", images=[], priority='interactive',
+                 submitted_time=None, timeline=None, **other):
         """Init a task."""
 
         self.task_id = task_id
@@ -38,4 +84,305 @@ class Task(Model):
         self.part_args = part_args
         self.body = body
         self.images = images
+        self.priority = priority
+        self.submitted_time = submitted_time
+        if not self.submitted_time:
+            self.submitted_time = time.time()
+        self.timeline = dict(timeline or {})
+        self.timeline.setdefault('submitted', self.submitted_time)
+
+    @classmethod
+    def _pending_query(cls, window=0, waiting=None):
+        query = {'status': 'new'}
+        if window:
+            query['_id'] = {'$lt': DB.id_before(time.time() - window)}
+        if waiting:
+            query['$nor'] = waiting
+        return query
+
+    @classmethod
+    def pending_heads(cls, window=0, waiting=None):
+        """Get the oldest claimable new task of every user and priority.
+
+            Documents in `waiting` are skipped.
+
+            Return:
+                list of dicts of task_id, user_id, document_id, priority
+                and count of the user's new tasks of this priority
+        """
+        pipeline = [
+            {'$match': cls._pending_query(window, waiting)},
+            {'$sort': {'_id': 1}},
+            {'$group': {
+                '_id': {'user_id': '$user_id', 'priority': '$priority'},
+                'task_id': {'$first': '$_id'},
+                'document_id': {'$first': '$document_id'},
+                'count': {'$sum': 1}
+            }}
+        ]
+        heads = []
+        for result in DB.aggregate(cls.name, pipeline):
+            heads.append({
+                'task_id': str(result['task_id']),
+                'user_id': result['_id'].get('user_id'),
+                'document_id': result.get('document_id'),
+                'priority': result['_id'].get('priority') or 'interactive',
+                'count': result['count']
+            })
+        return heads
+
+    @classmethod
+    def pending_count(cls, user_id, limit=0):
+        """Count a user's new and compiling tasks, counting stops at
+        `limit` if set."""
+        query = {'user_id': user_id, 'status': {'$in': ['new', 'compiling']}}
+        return DB.count(cls.name, query, limit=limit)
+
+    @classmethod
+    def running_counts(cls):
+        """Get numbers of compiling tasks by user id."""
+        pipeline = [
+            {'$match': {'status': 'compiling'}},
+            {'$group': {'_id': '$user_id', 'count': {'$sum': 1}}}
+        ]
+        return {
+            result['_id']: result['count']
+            for result in DB.aggregate(cls.name, pipeline)
+        }
+
+    @classmethod
+    def claim_document(cls, user_id, document_id, fields=compile_fields,
+                       policy='wait', owner=None, lease_time=60):
+        """Claim the newest new task of a document.
+
+            All new tasks of a document are coalesced into the newest one,
+            the others are marked superseded. If the document is still
+            compiling, nothing is claimed with the `wait` policy, or the
+            running task is superseded with the `preempt` policy.
+
+            The task is claimed by a find-and-modify on the document and
+            status, so monitors running at the same time never claim the
+            same task. The claim is leased to `owner` for `lease_time`
+            seconds, see `renew_leases` and `reclaim_expired`.
+
+            Return:
+                (claimed task or None, superseded tasks), only `fields`
+                are loaded of the claimed task
+        """
+        document = {'user_id': user_id, 'document_id': document_id}
+        running = [
+            result['_id'] for result in DB.find(
+                cls.name, dict(document, status='compiling'),
+                projection=['_id'])
+        ]
+        if running and policy != 'preempt':
+            return None, []
+        # compile the newest revision
+        claimed_time = time.time()
+        result = DB.find_one_and_update(
+            cls.name,
+            dict(document, status='new'),
+            {'$set': {'status': 'compiling', 'claimed_time': claimed_time,
+                      'timeline.claimed': claimed_time, 'owner': owner,
+                      'lease_expires': time.time() + lease_time},
+             '$inc': {'attempts': 1}},
+            projection=fields,
+            sort=[('_id', -1)]
+        )
+        if not result:
+            return None, []
+        newest_id = result.pop('_id')
+        result[cls.id_key] = str(newest_id)
+        if 'submitted_time' in fields and 'submitted_time' not in result:
+            result['submitted_time'] = DB.id_time(newest_id)
+        task = cls(**result)
+        task._mark_saved(result.keys())
+        # supersede older revisions, running ones are preempted
+        superseded = []
+        older = [
+            result['_id'] for result in DB.find(
+                cls.name,
+                dict(document, status='new', _id={'$lt': newest_id}),
+                projection=['_id'])
+        ]
+        for task_ids, status in ((older, 'new'), (running, 'compiling')):
+            if not task_ids:
+                continue
+            DB.update_many(
+                cls.name, {'_id': {'$in': task_ids}, 'status': status},
+                {'status': 'superseded', 'superseded_by': task.task_id})
+            for task_id in task_ids:
+                superseded_task = cls(task_id=str(task_id), status='superseded')
+                superseded_task.superseded_by = task.task_id
+                superseded.append(superseded_task)
+        return task, superseded
+
+    def result(self, **fields):
+        """Get a copy of this claimed task with only `fields` set.
+
+            Compilers send results to the monitor without the document,
+            updating the copy only writes `fields`.
+
+        """
+        result = self.__class__(
+            task_id=self.task_id, user_id=self.user_id,
+            document_id=self.document_id, status='compiling',
+            timeline=self.timeline)
+        result._mark_saved(['user_id', 'document_id', 'status'])
+        for field, value in fields.items():
+            setattr(result, field, value)
+        return result
+
+    def stamp(self, *events):
+        """Record the current time of timeline events."""
+        now = time.time()
+        self.timeline = dict(
+            self.timeline, **{event: now for event in events})
+
+    @classmethod
+    def latency_report(cls, since, until=None, template=None,
+                       status='finished', max_tasks=20000):
+        """Get percentiles of timeline phases of tasks with `status`
+        finished in a window.
+
+            Percentiles are computed by the db over at most `max_tasks`
+            latest tasks, phases missing an entry are skipped, e.g. the
+            tex phase of cached results.
+
+            Return:
+                {'all': {phase: {'count': n, 'p50': seconds, ...}},
+                 'templates': {template: {phase: {...}}}}
+        """
+        finished = {'$gte': since}
+        if until:
+            finished['$lt'] = until
+        match = {'timeline.finished': finished}
+        if status:
+            match['status'] = status
+        if template:
+            match['template'] = template
+        phases = [
+            {'phase': phase, 'seconds': {
+                '$subtract': ['$timeline.' + end, '$timeline.' + start]}}
+            for phase, start, end in cls.timeline_phases
+        ]
+
+        def percentiles(group_id):
+            # nearest rank of durations sorted before grouping
+            ranks = {
+                'p%d' % p: {'$arrayElemAt': ['$values', {'$floor': {
+                    '$add': [{'$multiply': [
+                        p / 100, {'$subtract': ['$count', 1]}]}, 0.5]}}]}
+                for p in cls.report_percentiles
+            }
+            return [
+                {'$group': {
+                    '_id': group_id,
+                    'values': {'$push': '$phases.seconds'},
+                    'count': {'$sum': 1}
+                }},
+                {'$project': dict(ranks, count=1)}
+            ]
+
+        pipeline = [
+            {'$match': match},
+            {'$sort': {'timeline.finished': -1}},
+            {'$limit': max_tasks},
+            {'$project': {'template': 1, 'phases': phases}},
+            {'$unwind': '$phases'},
+            {'$match': {'phases.seconds': {'$type': 'number'}}},
+            {'$sort': {'phases.seconds': 1}},
+            {'$facet': {
+                'all': percentiles('$phases.phase'),
+                'templates': percentiles(
+                    {'template': '$template', 'phase': '$phases.phase'})
+            }}
+        ]
+        order = [phase for phase, start, end in cls.timeline_phases]
+        report = {'all': {}, 'templates': {}}
+        for result in DB.aggregate(cls.name, pipeline):
+            for row in sorted(result['all'],
+                              key=lambda row: order.index(row['_id'])):
+                report['all'][row.pop('_id')] = row
+            for row in sorted(result['templates'],
+                              key=lambda row: order.index(row['_id']['phase'])):
+                group = row.pop('_id')
+                report['templates'].setdefault(
+                    group.get('template') or '', {})[group['phase']] = row
+        return report
+
+    @classmethod
+    def renew_leases(cls, owner, task_ids, lease_time):
+        """Extend leases of tasks still compiling by `owner`.
+
+            Return:
+                number of renewed leases
+        """
+        if not task_ids:
+            return 0
+        query = {
+            '_id': {'$in': DB.object_ids(task_ids)},
+            'owner': owner,
+            'status': 'compiling'
+        }
+        return DB.update_many(
+            cls.name, query, {'lease_expires': time.time() + lease_time})
+
+    @classmethod
+    def reclaim_expired(cls, max_attempts):
+        """Release compiling tasks whose lease expired.
+
+            Owners of these tasks died or lost the db, the tasks are
+            compiled again unless claimed `max_attempts` times already.
+
+            Return:
+                (tasks to retry, failed tasks)
+        """
+        query = {
+            'status': 'compiling',
+            '$or': [
+                {'lease_expires': {'$lt': time.time()}},
+                {'lease_expires': None}
+            ]
+        }
+        retried = []
+        failed = []
+        for result in DB.find(cls.name, query, projection=['attempts']):
+            status = 'new'
+            if (result.get('attempts') or 0) >= max_attempts:
+                status = 'failed'
+            # renewed or reclaimed by another monitor meanwhile
+            released = DB.update_one(
+                cls.name, dict(query, _id=result['_id']),
+                {'status': status, 'owner': None, 'lease_expires': None})
+            if not released:
+                continue
+            task = cls(task_id=str(result['_id']), status=status)
+            if status == 'new':
+                retried.append(task)
+            else:
+                failed.append(task)
+        return retried, failed
+
+    def is_compiling(self):
+        """Check if this task is still claimed for compiling, it is not if
+        deleted or superseded."""
+        result = DB.find_one(
+            self.__class__.name, {'_id': self.task_id, 'status': 'compiling'},
+            projection=['_id'])
+        return result is not None
 
+    @classmethod
+    def next_claim_time(cls, window):
+        """Get when the next new task within `window` can be claimed, None
+        if no such task."""
+        query = {
+            'status': 'new',
+            '_id': {'$gte': DB.id_before(time.time() - window)}
+        }
+        results = list(DB.find(cls.name, query, projection=['_id'],
+                               sort=[('_id', 1)], limit=1))
+        if not results:
+            return None
+        # ids only have seconds
+        return DB.id_time(results[0]['_id']) + window + 1
@@ -1,5 +1,6 @@
 # coding: utf-8
 
+from .db import DB
 from .model import Model
 
 
@@ -24,3 +25,30 @@ class User(Model):
         self.user_id = user_id
         self.compiled_pdfs = compiled_pdfs
 
+    @classmethod
+    def add_compiled_pdfs(cls, user_pdfs, max_pdfs=0):
+        """Append compiled pdfs to users' lists in one bulk write.
+
+            `user_pdfs` is a list of (user id, pdf id). A pdf already in
+            the list is not added again, only the latest `max_pdfs` are
+            kept if provided. Pdfs of invalid user ids are skipped.
+
+            Return:
+                number of updated users' lists
+        """
+        updates = []
+        for user_id, pdf_id in user_pdfs:
+            try:
+                user_id = DB.object_ids([user_id])[0]
+            except Exception as e:
+                print('Fail to add pdf', pdf_id, 'to user', user_id,
+                      'Error: ', e)
+                continue
+            push = {'$each': [pdf_id]}
+            if max_pdfs:
+                push['$slice'] = -max_pdfs
+            updates.append((
+                {'_id': user_id, 'compiled_pdfs': {'$ne': pdf_id}},
+                {'$push': {'compiled_pdfs': push}}
+            ))
+        return DB.bulk_update(cls.name, updates)